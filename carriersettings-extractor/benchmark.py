@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os.path
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from xml.etree import ElementTree as ET
+from xml.parsers import expat
+
+from google.protobuf.internal import api_implementation
+
+from carrier_settings_pb2 import (ApnItem, CarrierConfig, CarrierSettings,
+                                  MultiCarrierSettings)
+from carrier_list_pb2 import CarrierList
+from carrierId_pb2 import CarrierList as CarrierIdList
+import carriersettings_extractor as extractor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark carriersettings_extractor on a synthetic CarrierSettings corpus")
+    parser.add_argument('-o', '--output', help='JSON results file (default: stdout)')
+    parser.add_argument('--compare', help='Previous JSON results file to compare against')
+    parser.add_argument('--corpus', help='Folder to generate the corpus in (default: temporary)')
+    parser.add_argument('--carriers', type=int, default=500,
+                        help='Number of carriers (default: %(default)s)')
+    parser.add_argument('--apns', type=int, default=4,
+                        help='APNs per carrier (default: %(default)s)')
+    parser.add_argument('--configs', type=int, default=40,
+                        help='Configs per carrier (default: %(default)s)')
+    parser.add_argument('--bundle-depth', type=int, default=2,
+                        help='Nesting depth of bundle configs (default: %(default)s)')
+    parser.add_argument('--bundle-size', type=int, default=4,
+                        help='Configs per bundle (default: %(default)s)')
+    parser.add_argument('--shared', type=float, default=0.0,
+                        help='Fraction of configs shared with other carriers (default: %(default)s)')
+    parser.add_argument('--generic', type=float, default=0.3,
+                        help='Fraction of carriers stored in others.pb (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the corpus (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to render the carriers')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of timed runs (default: %(default)s)')
+    return parser.parse_args()
+
+
+def load_mccmnc_tuples():
+    carrier_id_list = CarrierIdList()
+    with open(extractor.carrier_id_database, 'rb') as pb:
+        carrier_id_list.ParseFromString(pb.read())
+    return sorted({
+        mccmnc
+        for carrier_id_obj in carrier_id_list.carrier_id
+        for carrier_attribute in carrier_id_obj.carrier_attribute
+        for mccmnc in carrier_attribute.mccmnc_tuple
+    })
+
+
+def generate_configs(rng, carrier_config, count, depth, bundle_size):
+    """Fill carrier_config with count configs of every value type.
+
+    A few keys are taken from the extractor's config rules, so that filtering
+    is exercised too.
+    """
+    unwanted_keys = list(extractor.config_rules.keys)
+    threshold_keys = list(extractor.config_rules.max_items)
+    value_types = ['text_value', 'int_value', 'long_value', 'bool_value',
+                   'text_array', 'int_array', 'double_value']
+    if depth > 0:
+        value_types.append('bundle')
+    for i in range(count):
+        config = carrier_config.config.add()
+        value_type = rng.choice(value_types)
+        config.key = '{}_{}_{}'.format(value_type, depth, i)
+        if value_type == 'text_value':
+            config.text_value = rng.choice(['', 'value', 'a<b&c', '"quoted"'])
+        elif value_type == 'int_value':
+            config.int_value = rng.randint(-1, 1000)
+        elif value_type == 'long_value':
+            config.long_value = rng.randint(0, 1 << 40)
+        elif value_type == 'bool_value':
+            config.bool_value = rng.random() < 0.5
+            if rng.random() < 0.05:
+                config.key = rng.choice(unwanted_keys)
+        elif value_type == 'text_array':
+            config.text_array.SetInParent()
+            config.text_array.item.extend(
+                'item{}'.format(j) for j in range(rng.randint(0, 4)))
+        elif value_type == 'int_array':
+            config.int_array.SetInParent()
+            config.int_array.item.extend(range(rng.randint(0, 6)))
+            if rng.random() < 0.1:
+                config.key = rng.choice(threshold_keys)
+        elif value_type == 'double_value':
+            config.double_value = rng.random()
+        else:
+            config.bundle.SetInParent()
+            generate_configs(rng, config.bundle, bundle_size, depth - 1,
+                             bundle_size)
+
+
+def generate_apn(rng, apn, index):
+    apn.name = 'Synthetic APN {}'.format(index)
+    apn.value = 'apn{}.example.com'.format(index)
+    apn.type.extend(rng.sample(range(len(ApnItem.ApnType.values())),
+                               rng.randint(1, 3)))
+    apn.protocol = rng.choice(ApnItem.Protocol.values())
+    apn.roaming_protocol = rng.choice(ApnItem.Protocol.values())
+    if rng.random() < 0.5:
+        apn.mmsc = 'http://mms.example.com/?a=1&b=2'
+        apn.mmsc_proxy = '10.0.0.1'
+        apn.mmsc_proxy_port = '8080'
+    if rng.random() < 0.3:
+        apn.authtype = rng.randint(0, 3)
+        apn.user = 'user'
+        apn.password = 'password'
+    if rng.random() < 0.3:
+        apn.user_visible = False
+    if rng.random() < 0.3:
+        apn.skip_464xlat = rng.choice(ApnItem.Xlat.values())
+    apn.mtu = rng.choice([0, 1400, 1500])
+
+
+def generate_corpus(folder, carriers=500, apns=4, configs=40, bundle_depth=2,
+                    bundle_size=4, generic=0.3, shared=0.0, seed=0):
+    """Write a synthetic CarrierSettings folder and return its statistics.
+
+    The folder holds a carrier_list.pb, an others.pb with a fraction of the
+    carriers and one .pb file for every other carrier. The first carrier is
+    the no SIM carrier. A fraction shared of the configs of every carrier are
+    identical to those of other carriers, like real GPS or threshold settings.
+    """
+    rng = random.Random(seed)
+    mccmnc_tuples = load_mccmnc_tuples()
+    shared_configs = CarrierConfig()
+    generate_configs(random.Random(seed + 1), shared_configs, configs,
+                     bundle_depth, bundle_size)
+    os.makedirs(folder, exist_ok=True)
+
+    carrier_list = CarrierList()
+    multi_settings = MultiCarrierSettings()
+    for i in range(carriers):
+        setting = CarrierSettings()
+        setting.canonical_name = 'synthetic_{}'.format(i)
+        setting.version = seed
+        for j in range(apns):
+            generate_apn(rng, setting.apns.apn.add(), j)
+        setting.configs.SetInParent()
+        generate_configs(rng, setting.configs, configs, bundle_depth,
+                         bundle_size)
+        if shared:
+            # Shared configs replace those with the same index, and key
+            for config, shared_config in zip(setting.configs.config,
+                                             shared_configs.config):
+                if rng.random() < shared:
+                    config.CopyFrom(shared_config)
+
+        entry = carrier_list.entry.add()
+        entry.canonical_name = setting.canonical_name
+        carrier_id = entry.carrier_id.add()
+        if i == 0:
+            carrier_id.mcc_mnc = '000000'
+        else:
+            carrier_id.mcc_mnc = rng.choice(mccmnc_tuples)
+            mvno = rng.random()
+            if mvno < 0.1:
+                carrier_id.spn = 'Synthetic {}'.format(i)
+            elif mvno < 0.2:
+                carrier_id.gid1 = '{:02x}'.format(i % 256)
+            elif mvno < 0.3:
+                carrier_id.imsi = carrier_id.mcc_mnc + 'x1'
+
+        if rng.random() < generic:
+            multi_settings.setting.append(setting)
+        else:
+            with open(os.path.join(folder, setting.canonical_name + '.pb'), 'wb') as pb:
+                pb.write(setting.SerializeToString())
+
+    with open(os.path.join(folder, 'carrier_list.pb'), 'wb') as pb:
+        pb.write(carrier_list.SerializeToString())
+    with open(os.path.join(folder, 'others.pb'), 'wb') as pb:
+        pb.write(multi_settings.SerializeToString())
+
+    return {
+        'carriers': carriers,
+        'apns': carriers * apns,
+        'configs': carriers * configs,
+        'generic_carriers': len(multi_settings.setting),
+    }
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.phases[self.name] = {
+            'wall': time.perf_counter() - self.wall,
+            'cpu': time.process_time() - self.cpu,
+        }
+
+
+def stream_validate(filename):
+    parser = expat.ParserCreate()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(64 * 1024)
+            parser.Parse(data, not data)
+            if not data:
+                break
+
+
+def run(corpus, output_folder, jobs=1):
+    """Run every extraction phase once without cache and return the timings."""
+    extractor.load_carrier_id_index.cache_clear()
+    extractor.load_apn_renderer.cache_clear()
+    extractor.load_config_interner.cache_clear()
+    extractor.interner_stats.clear()
+    apns_filename = os.path.join(output_folder, 'apns-conf.xml')
+    output_files = [
+        apns_filename,
+        os.path.join(output_folder, 'vendor.xml'),
+        os.path.join(output_folder, 'vendor_no_sim.xml'),
+    ]
+
+    timer = PhaseTimer()
+    with timer('load'):
+        carrier_list = extractor.load_carrier_list(corpus)
+        all_settings = extractor.CarrierSettingsLoader(corpus)
+    with timer('carrier_id_index'):
+        extractor.load_carrier_id_index(extractor.carrier_id_database)
+    # Carriers are decoded as they are written, in each of the two phases
+    with timer('apns'):
+        extractor.write_carrier_files(carrier_list, all_settings,
+                                      apns_filename=apns_filename, jobs=jobs)
+    with timer('carrier_configs'):
+        extractor.write_carrier_files(carrier_list, all_settings,
+                                      vendor_folder=output_folder, jobs=jobs)
+    all_settings.close()
+    with timer('validate_full'):
+        for filename in output_files:
+            ET.parse(filename)
+    with timer('validate_stream'):
+        for filename in output_files:
+            stream_validate(filename)
+    return timer.phases
+
+
+def summarize(runs):
+    """Return the fastest wall and CPU time of each phase over all runs."""
+    return {
+        phase: {
+            measure: min(run[phase][measure] for run in runs)
+            for measure in ('wall', 'cpu')
+        }
+        for phase in runs[0]
+    }
+
+
+def compare(previous, current):
+    for phase, timings in current['phases'].items():
+        if phase not in previous['phases']:
+            continue
+        old = previous['phases'][phase]['wall']
+        new = timings['wall']
+        print('{:<16} {:9.4f}s -> {:9.4f}s ({:+.1f}%)'.format(
+            phase, old, new, (new - old) / old * 100 if old else 0.0),
+            file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+
+    parameters = {
+        'carriers': args.carriers,
+        'apns': args.apns,
+        'configs': args.configs,
+        'bundle_depth': args.bundle_depth,
+        'bundle_size': args.bundle_size,
+        'generic': args.generic,
+        'shared': args.shared,
+        'seed': args.seed,
+        'jobs': args.jobs,
+        'repeat': args.repeat,
+    }
+    with tempfile.TemporaryDirectory(prefix='carriersettings-benchmark-') as tmp:
+        corpus = args.corpus or os.path.join(tmp, 'corpus')
+        output_folder = os.path.join(tmp, 'output')
+        os.makedirs(output_folder)
+        counts = generate_corpus(corpus, args.carriers, args.apns, args.configs,
+                                 args.bundle_depth, args.bundle_size,
+                                 args.generic, args.shared, args.seed)
+        runs = [run(corpus, output_folder, args.jobs) for _ in range(args.repeat)]
+        # Configs and bytes looked up and not already rendered in the last run
+        counts['interned'] = dict(extractor.interner_stats)
+        counts['output_bytes'] = {
+            name: os.path.getsize(os.path.join(output_folder, name))
+            for name in sorted(os.listdir(output_folder))
+        }
+
+    results = {
+        'parameters': parameters,
+        'environment': {
+            'python': platform.python_version(),
+            'protobuf': api_implementation.Type(),
+            'machine': platform.machine(),
+        },
+        'counts': counts,
+        'phases': summarize(runs),
+        'runs': runs,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
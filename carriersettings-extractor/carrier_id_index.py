@@ -0,0 +1,102 @@
+class CarrierIdIndex:
+    """Match carrier_list entries against the carrier ID database.
+
+    Every carrier attribute of the database is compiled into one record, which
+    is referenced from the bucket of each of its MCC/MNC tuples. IMSI prefix
+    patterns are stored in a trie per record, where 'x' matches any digit.
+    A carrier_list entry only holds an MCC/MNC and at most one of SPN, IMSI or
+    GID1, so attributes that also require a PLMN, preferred APN, ICCID prefix
+    or privilege access rule can never match and are left out.
+    """
+
+    def __init__(self, records=(), buckets=None):
+        # Each record is [canonical_id, spns, gid1s, imsi_trie]
+        self.records = list(records)
+        self.buckets = buckets or {}
+
+    @classmethod
+    def from_proto(cls, carrier_id_list):
+        index = cls()
+        for carrier_id_obj in carrier_id_list.carrier_id:
+            for carrier_attribute in carrier_id_obj.carrier_attribute:
+                if (carrier_attribute.plmn or
+                        carrier_attribute.preferred_apn or
+                        carrier_attribute.iccid_prefix or
+                        carrier_attribute.privilege_access_rule):
+                    continue
+                imsi_trie = {}
+                for pattern in carrier_attribute.imsi_prefix_xpattern:
+                    node = imsi_trie
+                    for char in pattern.lower():
+                        node = node.setdefault(char, {})
+                    node[''] = True
+                index.add(
+                    [s.lower() for s in carrier_attribute.mccmnc_tuple],
+                    [carrier_id_obj.canonical_id,
+                     sorted(set(s.lower() for s in carrier_attribute.spn)),
+                     sorted(set(s.lower() for s in carrier_attribute.gid1)),
+                     imsi_trie],
+                )
+        return index
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['records'], data['buckets'])
+
+    def to_json(self):
+        return {'records': self.records, 'buckets': self.buckets}
+
+    def add(self, mccmnc_tuples, record):
+        self.records.append(record)
+        for mccmnc in mccmnc_tuples or ['']:
+            self.buckets.setdefault(mccmnc, []).append(len(self.records) - 1)
+
+    def lookup(self, mcc_mnc, imsi='', spn='', gid1=''):
+        """Return the canonical ID of a carrier, or None if it is unknown.
+
+        Among the matching attributes, the one with the longest IMSI prefix
+        pattern wins, preferring literal digits over wildcards. Remaining ties
+        go to the attribute listed last in the database.
+        """
+        imsi = imsi.lower()
+        spn = spn.lower()
+        gid1 = gid1.lower()
+        best = None
+        best_rank = None
+        for record_index in self.buckets.get(mcc_mnc, []):
+            canonical_id, spns, gid1s, imsi_trie = self.records[record_index]
+            if spn not in (spns or ['']) or gid1 not in (gid1s or ['']):
+                continue
+            if imsi:
+                rank = match_imsi_prefix(imsi_trie, imsi)
+                if rank is None:
+                    continue
+            elif imsi_trie:
+                continue
+            else:
+                rank = (0, 0)
+            if best_rank is None or rank >= best_rank:
+                best = canonical_id
+                best_rank = rank
+        return best
+
+
+def match_imsi_prefix(imsi_trie, imsi):
+    """Return the (length, literal digits) of the best pattern prefixing imsi.
+
+    Returns None if no pattern in the trie matches.
+    """
+    best = None
+    stack = [(imsi_trie, 0, 0)]
+    while stack:
+        node, depth, literal = stack.pop()
+        if depth and '' in node and (best is None or (depth, literal) > best):
+            best = (depth, literal)
+        if depth == len(imsi):
+            continue
+        char = imsi[depth]
+        if char in node:
+            stack.append((node[char], depth + 1, literal + 1))
+        if char != 'x' and 'x' in node:
+            stack.append((node['x'], depth + 1, literal))
+    return best
@@ -0,0 +1,228 @@
+import hashlib
+import os
+import sqlite3
+import zlib
+
+from carrier_settings_pb2 import CarrierSettings
+from carriersettings_files import (iter_fields, read_canonical_name,
+                                   settings_filenames)
+from carriersettings_sqlite import config_rows
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS manifest (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id),
+    filename TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    field INTEGER,
+    canonical_name TEXT,
+    active INTEGER NOT NULL,
+    blob INTEGER NOT NULL REFERENCES blobs (id),
+    PRIMARY KEY (snapshot, filename, position)
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+-- Configs of every carrier blob, clustered by path for history queries
+CREATE TABLE IF NOT EXISTS configs (
+    path INTEGER NOT NULL REFERENCES paths (id),
+    blob INTEGER NOT NULL REFERENCES blobs (id),
+    type TEXT,
+    value,
+    PRIMARY KEY (path, blob)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS manifest_canonical_name
+    ON manifest (canonical_name, snapshot);
+'''
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def file_rows(filename, data):
+    """Split a CarrierSettings folder file into its manifest rows.
+
+    Rows are (field, canonical name, blob) tuples, in file order. others.pb
+    is split into its fields, with each CarrierSettings stored on its own so
+    that carriers unchanged between snapshots share their blob even though
+    others.pb changed. The blob of a row with a field number is the value of
+    that length-delimited field, and that of a row without one the bytes
+    written as they are. Other files are stored whole.
+    """
+    name = os.path.basename(filename)
+    if name == 'carrier_list.pb':
+        return [(None, None, data)]
+    if name != 'others.pb':
+        return [(None, read_canonical_name(data, 0, len(data)), data)]
+    rows = []
+    for number, wire_type, start, end, field_start in iter_fields(data, 0, len(data)):
+        # MultiCarrierSettings.setting is field 2
+        if number == 2 and wire_type == 2:
+            rows.append((2, read_canonical_name(data, start, end), data[start:end]))
+        else:
+            rows.append((None, None, data[field_start:end]))
+    return rows
+
+
+def join_rows(rows):
+    """Return the content of a file from its (field, blob) manifest rows."""
+    return b''.join(
+        blob if field is None else
+        encode_varint(field << 3 | 2) + encode_varint(len(blob)) + blob
+        for field, blob in rows)
+
+
+class Archive:
+    """History of CarrierSettings folders, stored in an SQLite database.
+
+    Every file of a snapshot is stored as content-addressed, zlib compressed
+    blobs, each stored once however many snapshots have it, and listed in the
+    manifest of the snapshot. The configs of each carrier blob are indexed
+    once too, so the history of a config of a carrier is a single query.
+    Should a carrier have the same config twice, the last one is indexed.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self.paths = dict(self.db.execute('SELECT path, id FROM paths'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def snapshot_id(self, name):
+        row = self.db.execute('SELECT id FROM snapshots WHERE name = ?',
+                              (name,)).fetchone()
+        if row is None:
+            raise ValueError('No snapshot named {}'.format(name))
+        return row[0]
+
+    def snapshots(self):
+        return [name for name, in self.db.execute(
+            'SELECT name FROM snapshots ORDER BY id')]
+
+    def store_blob(self, data):
+        """Store a blob unless already archived and return its ID and
+        whether it is new.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        row = self.db.execute('SELECT id FROM blobs WHERE digest = ?',
+                              (digest,)).fetchone()
+        if row is not None:
+            return row[0], False
+        return self.db.execute(
+            'INSERT INTO blobs (digest, size, data) VALUES (?, ?, ?)',
+            (digest, len(data), zlib.compress(data, 9))).lastrowid, True
+
+    def path_id(self, path):
+        if path not in self.paths:
+            self.paths[path] = self.db.execute(
+                'INSERT INTO paths (path) VALUES (?)', (path,)).lastrowid
+        return self.paths[path]
+
+    def index_configs(self, blob, setting):
+        self.db.executemany(
+            'INSERT OR REPLACE INTO configs VALUES (?, ?, ?, ?)',
+            [(self.path_id(path), blob, value_type, value)
+             for _, path, _, _, value_type, value
+             in config_rows(None, setting.configs)])
+
+    def add(self, name, input_folder):
+        """Archive a CarrierSettings folder as the snapshot name.
+
+        Returns the number of files and blobs of the snapshot and how many of
+        the blobs were new.
+        """
+        counts = {'files': 0, 'blobs': 0, 'new_blobs': 0}
+        with self.db:
+            if self.db.execute('SELECT 1 FROM snapshots WHERE name = ?',
+                               (name,)).fetchone():
+                raise ValueError('Snapshot {} already exists'.format(name))
+            snapshot = self.db.execute('INSERT INTO snapshots (name) VALUES (?)',
+                                       (name,)).lastrowid
+            filenames = [os.path.join(input_folder, 'carrier_list.pb')] + \
+                settings_filenames(input_folder)
+            manifest = []
+            # The extractor uses the last settings of each carrier, in the
+            # order of settings_filenames()
+            active = {}
+            for filename in filenames:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                rows = file_rows(filename, data)
+                if join_rows((field, blob) for field, _, blob in rows) != data:
+                    # Keep files that would not be written back as they are
+                    rows = [(None, None, data)]
+                basename = os.path.basename(filename)
+                for position, (field, canonical_name, blob) in enumerate(rows):
+                    blob_id, new = self.store_blob(blob)
+                    if new and canonical_name is not None:
+                        self.index_configs(blob_id, CarrierSettings.FromString(blob))
+                    if canonical_name is not None:
+                        active[canonical_name] = (basename, position)
+                    manifest.append([snapshot, basename, position, field,
+                                     canonical_name, 0, blob_id])
+                    counts['blobs'] += 1
+                    counts['new_blobs'] += new
+                counts['files'] += 1
+            for row in manifest:
+                row[5] = int(active.get(row[4]) == (row[1], row[2]))
+            self.db.executemany('INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                manifest)
+        return counts
+
+    def checkout(self, name, output_folder):
+        """Write the files of a snapshot to output_folder, as they were added."""
+        files = {}
+        for filename, field, data in self.db.execute('''
+                SELECT filename, field, data FROM manifest
+                JOIN blobs ON blobs.id = manifest.blob
+                WHERE snapshot = ?
+                ORDER BY filename, position''', (self.snapshot_id(name),)):
+            files.setdefault(filename, []).append((field, zlib.decompress(data)))
+        os.makedirs(output_folder, exist_ok=True)
+        for filename, rows in files.items():
+            with open(os.path.join(output_folder, filename), 'wb') as f:
+                f.write(join_rows(rows))
+        return list(files)
+
+    def history(self, canonical_name, path):
+        """Return the config path of a carrier in each snapshot.
+
+        Returns (snapshot, type, value) tuples in the order the snapshots were
+        added. The type is None for snapshots where the carrier has no such
+        config, and the snapshots without the carrier are left out.
+        """
+        return self.db.execute('''
+            SELECT snapshots.name, configs.type, configs.value
+            FROM manifest
+            JOIN snapshots ON snapshots.id = manifest.snapshot
+            LEFT JOIN configs ON configs.blob = manifest.blob AND configs.path =
+                (SELECT id FROM paths WHERE path = ?)
+            WHERE manifest.canonical_name = ? AND manifest.active
+            ORDER BY snapshots.id''', (path, canonical_name)).fetchall()
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+
+
+class ExtractionCache:
+    """On-disk cache of rendered XML fragments.
+
+    Values are stored as JSON, one file per key, named after the hash of the
+    key and a salt. Changing the salt invalidates every entry. Once the cache
+    grows past max_size bytes, prune() evicts the least recently used entries.
+    """
+
+    def __init__(self, directory, max_size, salt=()):
+        self.directory = directory
+        self.max_size = max_size
+        self.salt = list(salt)
+        os.makedirs(directory, exist_ok=True)
+
+    def __eq__(self, other):
+        return (isinstance(other, ExtractionCache) and
+                (self.directory, self.max_size, self.salt) ==
+                (other.directory, other.max_size, other.salt))
+
+    def __hash__(self):
+        return hash((self.directory, self.max_size, tuple(self.salt)))
+
+    def path(self, key):
+        digest = hashlib.sha256(
+            json.dumps(self.salt + list(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                value = json.load(f)
+            # The modification time orders eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        # Write to a private file first, so concurrent runs sharing the cache
+        # never see partial entries.
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def prune(self):
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class PayloadStore:
+    """In-memory store of rendered fragments.
+
+    Fragments are keyed by the same keys as in ExtractionCache, so identical
+    files loaded from several folders are rendered once. The folders each
+    file was loaded from are recorded in files, by payload key.
+    """
+
+    def __init__(self):
+        self.fragments = {}
+        self.files = {}
@@ -0,0 +1,166 @@
+import json
+
+from carriersettings_files import CarrierSettingsLoader, load_carrier_list
+
+
+def is_repeated(field):
+    # Newer protobuf releases replace FieldDescriptor.label with is_repeated
+    if hasattr(field, 'is_repeated'):
+        return field.is_repeated
+    return field.label == field.LABEL_REPEATED
+
+
+def message_fields(message):
+    """Return the set fields of a message, with enums as names."""
+    fields = {}
+    for field, value in message.ListFields():
+        repeated = is_repeated(field)
+        if field.enum_type is not None:
+            names = field.enum_type.values_by_number
+            value = [names[v].name for v in value] if repeated else names[value].name
+        elif repeated:
+            value = list(value)
+        elif field.message_type is not None:
+            value = message_fields(value)
+        fields[field.name] = value
+    return fields
+
+
+def flatten_configs(carrier_config, prefix=''):
+    """Return the configs of a CarrierConfig, keyed by their path.
+
+    The configs of a bundle are keyed by the path of the bundle followed by a
+    slash and their own key. The bundle itself is listed with an empty value.
+    """
+    configs = {}
+    for config in carrier_config.config:
+        key = prefix + config.key
+        value_type = config.WhichOneof('value')
+        if value_type == 'bundle':
+            configs[key] = {}
+            configs.update(flatten_configs(config.bundle, key + '/'))
+        elif value_type in ('text_array', 'int_array'):
+            configs[key] = list(getattr(config, value_type).item)
+        elif value_type is not None:
+            configs[key] = getattr(config, value_type)
+        else:
+            configs[key] = None
+    return configs
+
+
+def index_apns(setting):
+    """Return the APNs of a carrier keyed by name, numbering duplicate names."""
+    apns = {}
+    for apn in setting.apns.apn:
+        key = apn.name
+        duplicate = 1
+        while key in apns:
+            duplicate += 1
+            key = '{} ({})'.format(apn.name, duplicate)
+        apns[key] = message_fields(apn)
+    return apns
+
+
+def diff_dicts(old, new, changed_value):
+    diff = {
+        'added': {key: new[key] for key in new if key not in old},
+        'removed': {key: old[key] for key in old if key not in new},
+        'changed': {},
+    }
+    for key in old:
+        if key in new and old[key] != new[key]:
+            diff['changed'][key] = changed_value(old[key], new[key])
+    return diff
+
+
+def diff_apn_fields(old, new):
+    return {
+        field: [old.get(field), new.get(field)]
+        for field in sorted(set(old) | set(new))
+        if old.get(field) != new.get(field)
+    }
+
+
+def diff_carrier(old, new):
+    return {
+        'apns': diff_dicts(index_apns(old), index_apns(new), diff_apn_fields),
+        'configs': diff_dicts(flatten_configs(old.configs),
+                              flatten_configs(new.configs),
+                              lambda old_value, new_value: [old_value, new_value]),
+    }
+
+
+def diff_carrier_lists(old, new):
+    old_entries = {entry.canonical_name: entry for entry in old.entry}
+    new_entries = {entry.canonical_name: entry for entry in new.entry}
+    return {
+        'added': sorted(name for name in new_entries if name not in old_entries),
+        'removed': sorted(name for name in old_entries if name not in new_entries),
+        'changed': sorted(
+            name for name in old_entries
+            if name in new_entries and
+            old_entries[name].SerializeToString() != new_entries[name].SerializeToString()
+        ),
+    }
+
+
+def diff_folders(old_folder, new_folder):
+    """Compare the CarrierSettings of two releases at the protobuf level.
+
+    Carriers whose serialized settings did not change between the releases
+    are skipped without decoding them.
+    """
+    with CarrierSettingsLoader(old_folder) as old_settings, \
+            CarrierSettingsLoader(new_folder) as new_settings:
+        changed = {}
+        for name in sorted(set(old_settings) & set(new_settings)):
+            if old_settings.raw(name) == new_settings.raw(name):
+                continue
+            changed[name] = diff_carrier(old_settings[name], new_settings[name])
+
+    return {
+        'carrier_list': diff_carrier_lists(load_carrier_list(old_folder),
+                                           load_carrier_list(new_folder)),
+        'carriers': {
+            'added': sorted(set(new_settings) - set(old_settings)),
+            'removed': sorted(set(old_settings) - set(new_settings)),
+            'changed': changed,
+        },
+    }
+
+
+def format_value(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def format_diff(diff):
+    """Return a human-readable report of a diff_folders() result."""
+    lines = []
+    for change, sign in (('added', '+'), ('removed', '-'), ('changed', '~')):
+        for name in diff['carrier_list'][change]:
+            lines.append('{} carrier_list entry {}'.format(sign, name))
+    for name in diff['carriers']['added']:
+        lines.append('+ carrier {}'.format(name))
+    for name in diff['carriers']['removed']:
+        lines.append('- carrier {}'.format(name))
+    for name, carrier_diff in diff['carriers']['changed'].items():
+        lines.append('~ carrier {}'.format(name))
+        apns = carrier_diff['apns']
+        for key in apns['added']:
+            lines.append('    + apn {}'.format(format_value(key)))
+        for key in apns['removed']:
+            lines.append('    - apn {}'.format(format_value(key)))
+        for key, fields in apns['changed'].items():
+            lines.append('    ~ apn {}'.format(format_value(key)))
+            for field, (old, new) in fields.items():
+                lines.append('        {}: {} -> {}'.format(
+                    field, format_value(old), format_value(new)))
+        configs = carrier_diff['configs']
+        for key, value in configs['added'].items():
+            lines.append('    + {} = {}'.format(key, format_value(value)))
+        for key, value in configs['removed'].items():
+            lines.append('    - {} = {}'.format(key, format_value(value)))
+        for key, (old, new) in configs['changed'].items():
+            lines.append('    ~ {}: {} -> {}'.format(
+                key, format_value(old), format_value(new)))
+    return '\n'.join(lines)
@@ -1,19 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections import OrderedDict
-from glob import glob
-from itertools import product
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache, partial
+from itertools import islice
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os.path
+import re
 import sys
+import tempfile
+import time
 from xml.etree import ElementTree as ET
+from xml.parsers import expat
 from xml.sax.saxutils import escape, quoteattr
 
-from carrier_settings_pb2 import CarrierSettings, MultiCarrierSettings
-from carrier_list_pb2 import CarrierList
+from carrier_id_index import CarrierIdIndex
+from carriersettings_cache import ExtractionCache, PayloadStore
+from carriersettings_files import (CarrierSettingsLoader, file_digest,
+                                   load_carrier_list, split_configs)
+from carriersettings_profile import NullProfiler, Profiler
+from config_rules import ConfigRules
+from carrier_settings_pb2 import ApnItem, CarrierConfig
 from carrierId_pb2 import CarrierList as CarrierIdList
 
 
+carrier_id_database = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                   'carrier_list.pb')
+config_rules_file = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                 'config_rules.json')
+config_rules = ConfigRules.load(config_rules_file)
+# Replaced by a Profiler to time the extraction phases
+profiler = NullProfiler()
+# Configs and bytes looked up by the ConfigInterner of this process, and how
+# many of them were not already rendered
+interner_stats = Counter()
+
+
 def indent(elem, level=0):
     """Based on https://effbot.org/zone/element-lib.htm#prettyprint"""
     i = "\n" + level * "    "
@@ -31,45 +58,185 @@ def indent(elem, level=0):
             elem.tail = i
 
 
+def carrier_config_fragment(element):
+    """Serialize a <carrier_config> element indented as a child of the root."""
+    with profiler.phase('indent'):
+        indent(element, 1)
+    element.tail = None
+    with profiler.phase('serialize'):
+        return ET.tostring(element, encoding='unicode')
+
+
+class XMLOutputFile:
+    """Text file that can check that the XML written to it is well-formed.
+
+    With validation enabled, everything written is also fed to an incremental
+    expat parser, so errors are reported as soon as the offending text is
+    written, along with its context, without reading the file back.
+    """
+
+    def __init__(self, filename, validate=False, errors='strict'):
+        self.filename = filename
+        self.file = open(filename, 'w', encoding='utf-8', errors=errors)
+        self.parser = expat.ParserCreate() if validate else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write(self, data, context=None):
+        with profiler.phase('write'):
+            self.file.write(data)
+            if self.parser is not None:
+                self.parse(data, False, context)
+
+    def parse(self, data, final, context):
+        try:
+            with profiler.phase('validate_stream'):
+                self.parser.Parse(data, final)
+        except expat.ExpatError as e:
+            location = os.path.basename(self.filename)
+            if context is not None:
+                location += ' ({})'.format(context)
+            error = ET.ParseError('{}: {}'.format(location, e))
+            error.code = e.code
+            error.position = (e.lineno, e.offset)
+            raise error from e
+
+    def close(self):
+        self.file.close()
+        if self.parser is not None:
+            self.parse('', True, None)
+
+
+class CarrierConfigListWriter:
+    """Incrementally write a carrier_config_list document.
+
+    Each <carrier_config> fragment, as returned by carrier_config_fragment(),
+    is written as soon as it is available, so the whole tree is never held in
+    memory. The output is identical to building the full tree, running indent()
+    on it and calling ElementTree.write() with an XML declaration.
+    """
+
+    def __init__(self, filename, validate=False):
+        self.file = XMLOutputFile(filename, validate,
+                                  errors='xmlcharrefreplace')
+        self.file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        self.empty = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.__exit__(exc_type, exc_value, traceback)
+
+    def write(self, fragment, context=None):
+        if self.empty:
+            self.file.write('<carrier_config_list>')
+            self.empty = False
+        self.file.write('\n    ' + fragment, context)
+
+    def close(self):
+        if self.empty:
+            self.file.write('<carrier_config_list />')
+        else:
+            self.file.write('\n</carrier_config_list>\n')
+        self.file.close()
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'carriersettings-extractor')
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Convert the CarrierSettings protobuf files to XML format compatible with AOSP")
-    parser.add_argument('-i', '--input', help='CarrierSettings folder',
-                        required=True)
+    parser.add_argument('-i', '--input', help='CarrierSettings folder')
     parser.add_argument('-a', '--apns', help='apns-conf.xml Output folder',
                         required=False)
-    parser.add_argument('-v', '--vendor', help='vendor.xml Output folder',
-                        required=True)
-    return parser.parse_args()
-
-
-unwanted_configs = [
-                    # Anything where the value is a package name
-                    "carrier_app_wake_signal_config",
-                    "carrier_settings_activity_component_name_string",
-                    "carrier_setup_app_string",
-                    "config_ims_package_override_string",
-                    "enable_apps_string_array",
-                    "gps.nfw_proxy_apps",
-                    "smart_forwarding_config_component_name_string",
-                    "wfc_emergency_address_carrier_app_string",
-                    # Always allow editing APNs
-                    "apn_expand_bool",
-                    "allow_adding_apns_bool",
-                    "read_only_apn_types_string_array",
-                    "read_only_apn_fields_string_array"]
-
-threshold_configs = ["5g_nr_ssrsrp_thresholds_int_array",
-                     "5g_nr_sssinr_thresholds_int_array",
-                     "gsm_rssi_thresholds_int_array",
-                     "lte_rsrp_thresholds_int_array",
-                     "lte_rssnr_thresholds_int_array",
-                     "wcdma_rscp_thresholds_int_array"]
-
-def extract_elements(carrier_config_element, config):
-    if config.key in unwanted_configs:
-        return
-    if config.key.startswith("moto_") or "_moto_" in config.key:
+    parser.add_argument('-v', '--vendor', help='vendor.xml Output folder')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to render the carriers')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Render every carrier without using the extraction cache')
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help='Extraction cache folder (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='Maximum extraction cache size in MiB (default: %(default)s)')
+    parser.add_argument('--validate', choices=['full', 'stream', 'off'],
+                        default='stream',
+                        help='Check that the generated XML is well-formed while '
+                        'writing it (stream), by parsing the written files '
+                        '(full) or not at all (default: %(default)s)')
+    parser.add_argument('--rules', default=config_rules_file,
+                        help='Rules for the carrier configs left out (default: %(default)s)')
+    parser.add_argument('--rule-stats', action='store_true',
+                        help='Print how many carrier configs each rule left out')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write the time and memory used by each phase '
+                        'and counts of what was extracted to FILE as JSON')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='Profile each phase with cProfile and save the '
+                        'statistics of the one that took longest to FILE')
+    parser.add_argument('--watch', metavar='SECONDS', type=float, nargs='?',
+                        const=1.0,
+                        help='Keep running and regenerate the outputs whenever '
+                        'the CarrierSettings files change, checking every '
+                        'SECONDS (default: %(const)s)')
+    parser.add_argument('--sqlite', metavar='FILE',
+                        help='Export the CarrierSettings folder to an SQLite '
+                        'database instead of converting it')
+    parser.add_argument('--archive', metavar='FILE',
+                        help='Archive of CarrierSettings snapshots')
+    parser.add_argument('--add-snapshot', metavar='NAME',
+                        help='Add the CarrierSettings folder to the archive '
+                        'as the snapshot NAME instead of converting it')
+    parser.add_argument('--snapshot', metavar='NAME',
+                        help='Convert the snapshot NAME of the archive '
+                        'instead of a CarrierSettings folder')
+    parser.add_argument('--history', nargs=2, metavar=('CARRIER', 'KEY'),
+                        help='Print the value of the config KEY of CARRIER '
+                        'in every snapshot of the archive, with the keys of '
+                        'enclosing bundles joined by /')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD_DIR', 'NEW_DIR'),
+                        help='Compare two CarrierSettings folders instead of converting one')
+    parser.add_argument('--diff-format', choices=['text', 'json'],
+                        default='text',
+                        help='Format of the --diff report (default: %(default)s)')
+    args = parser.parse_args()
+    if args.archive is None and (args.add_snapshot is not None or
+                                 args.snapshot is not None or
+                                 args.history is not None):
+        parser.error('--add-snapshot, --snapshot and --history require --archive')
+    if args.watch is not None and args.snapshot is not None:
+        parser.error('--watch cannot be used with --snapshot')
+    if args.watch is not None and (args.profile is not None or
+                                   args.cprofile is not None):
+        # The report is only written once extraction is done
+        parser.error('--watch cannot be used with --profile or --cprofile')
+    if args.diff is None and args.snapshot is None and args.history is None \
+            and args.input is None:
+        parser.error('the following arguments are required: -i/--input')
+    if args.diff is None and args.sqlite is None and args.add_snapshot is None \
+            and args.history is None and args.vendor is None:
+        parser.error('the following arguments are required: -v/--vendor')
+    return args
+
+
+def extract_elements(carrier_config_element, config, rules, hits):
+    rule = rules.drop_rule(config.key)
+    if rule is not None:
+        hits[rule] += 1
         return
 
     value_type = config.WhichOneof('value')
@@ -111,6 +278,10 @@ def extract_elements(carrier_config_element, config):
             str(getattr(config, value_type)).lower(),
         )
     elif value_type == 'text_array':
+        rule = rules.length_rule(config.key, len(getattr(config, value_type).item))
+        if rule is not None:
+            hits[rule] += 1
+            return
         carrier_config_subelement = ET.SubElement(
             carrier_config_element,
             'string-array',
@@ -127,7 +298,9 @@ def extract_elements(carrier_config_element, config):
             )
             carrier_config_item.set('value', value)
     elif value_type == 'int_array':
-        if config.key in threshold_configs and len(getattr(config, value_type).item) > 4:
+        rule = rules.length_rule(config.key, len(getattr(config, value_type).item))
+        if rule is not None:
+            hits[rule] += 1
             return
         carrier_config_subelement = ET.SubElement(
             carrier_config_element,
@@ -151,7 +324,7 @@ def extract_elements(carrier_config_element, config):
         )
         carrier_config_subelement.set('name', config.key)
         for value in getattr(config, value_type).config:
-            extract_elements(carrier_config_subelement, value)
+            extract_elements(carrier_config_subelement, value, rules, hits)
     elif value_type == 'double_value':
         carrier_config_subelement = ET.SubElement(
             carrier_config_element,
@@ -166,210 +339,311 @@ def extract_elements(carrier_config_element, config):
         raise TypeError("Unknown value type: {}".format(value_type))
 
 
-def extract_gps_elements(carrier_config_element, config):
+def extract_gps_elements(carrier_config_element, config, rules, hits):
     if not config.key.startswith('gps.'):
         return
-    extract_elements(carrier_config_element, config)
+    extract_elements(carrier_config_element, config, rules, hits)
 
 
-def main():
-    args = parse_args()
+@lru_cache(maxsize=None)
+def load_carrier_id_index(filename, cache=None):
+    with profiler.phase('carrier_id_index'):
+        return read_carrier_id_index(filename, cache)
 
-    input_folder = args.input
-    apns_folder = args.apns
-    vendor_folder = args.vendor
 
+def read_carrier_id_index(filename, cache=None):
+    if cache is not None:
+        data = cache.get(('carrier_id_index',))
+        if data is not None:
+            return CarrierIdIndex.from_json(data)
     carrier_id_list = CarrierIdList()
-    carrier_attribute_map = {}
-    with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'carrier_list.pb'), 'rb') as pb:
+    with open(filename, 'rb') as pb:
         carrier_id_list.ParseFromString(pb.read())
-    for carrier_id_obj in carrier_id_list.carrier_id:
-        for carrier_attribute in carrier_id_obj.carrier_attribute:
-            for carrier_attributes in product(*(
-                    (s.lower() for s in getattr(carrier_attribute, i) or [''])
-                    for i in [
-                            'mccmnc_tuple', 'imsi_prefix_xpattern', 'spn', 'plmn',
-                            'gid1', 'preferred_apn', 'iccid_prefix',
-                            'privilege_access_rule',
-                    ]
-            )):
-                carrier_attribute_map[carrier_attributes] = \
-                    carrier_id_obj.canonical_id
-
-    carrier_list = CarrierList()
-    all_settings = {}
-
-    carrier_list.ParseFromString(open(os.path.join(input_folder, 'carrier_list.pb'), 'rb').read())
-    # Load generic settings first
-    multi_settings = MultiCarrierSettings()
-    multi_settings.ParseFromString(open(os.path.join(input_folder, 'others.pb'), 'rb').read())
-    for setting in multi_settings.setting:
-        all_settings[setting.canonical_name] = setting
-    # Load carrier specific files last, to allow overriding generic settings
-    for filename in glob(os.path.join(input_folder, '*.pb')):
-        with open(filename, 'rb') as pb:
-            if os.path.basename(filename) == 'carrier_list.pb':
-                # Handled above already
-                continue
-            elif os.path.basename(filename) == 'others.pb':
-                # Handled above already
-                continue
-            else:
-                setting = CarrierSettings()
-                setting.ParseFromString(pb.read())
-                if setting.canonical_name in all_settings:
-                    print("Overriding generic settings for " + setting.canonical_name, file=sys.stderr)
-                all_settings[setting.canonical_name] = setting
-
-    carrier_config_root = ET.Element('carrier_config_list')
-    carrier_config_no_sim_root = ET.Element('carrier_config_list')
-
-    # Unfortunately, python processors like xml and lxml, as well as command-line
-    # utilities like tidy, do not support the exact style used by AOSP for
-    # apns-conf.xml:
-    #
-    #  * indent: 2 spaces
-    #  * attribute indent: 4 spaces
-    #  * blank lines between elements
-    #  * attributes after first indented on separate lines
-    #  * closing tags of multi-line elements on separate, unindented lines
-    #
-    # Therefore, we build the file without using an XML processor.
-
-    class ApnElement:
-        def __init__(self, apn, carrier_id):
-            self.apn = apn
-            self.carrier_id = carrier_id
-            self.attributes = OrderedDict()
-            self.add_attributes()
-
-        def add_attribute(self, key, field=None, value=None):
-            if value is not None:
-                self.attributes[key] = value
-            else:
-                if field is None:
-                    field = key
-                if self.apn.HasField(field):
-                    enum_type = self.apn.DESCRIPTOR.fields_by_name[field].enum_type
-                    value = getattr(self.apn, field)
-                    if key == 'skip_464xlat':
-                        self.attributes[key] = str(value - 1)
-                    elif enum_type is None:
-                        if isinstance(value, bool):
-                            self.attributes[key] = str(value).lower()
-                        else:
-                            self.attributes[key] = str(value)
-                    else:
-                        self.attributes[key] = \
-                            enum_type.values_by_number[value].name
-
-        def add_attributes(self):
-            try:
-                self.add_attribute(
-                    'carrier_id',
-                    value=str(carrier_attribute_map[(
-                        self.carrier_id.mcc_mnc,
-                        self.carrier_id.imsi,
-                        self.carrier_id.spn.lower(),
-                        '',
-                        self.carrier_id.gid1.lower(),
-                        '',
-                        '',
-                        '',
-                    )])
-                )
-            except KeyError:
-                pass
-            self.add_attribute('mcc', value=self.carrier_id.mcc_mnc[:3])
-            self.add_attribute('mnc', value=self.carrier_id.mcc_mnc[3:])
-            self.add_attribute('apn', 'value')
-            self.add_attribute('proxy')
-            self.add_attribute('port')
-            self.add_attribute('mmsc')
-            self.add_attribute('mmsproxy', 'mmsc_proxy')
-            self.add_attribute('mmsport', 'mmsc_proxy_port')
-            self.add_attribute('user')
-            self.add_attribute('password')
-            self.add_attribute('server')
-            self.add_attribute('authtype')
-            self.add_attribute(
-                'type',
-                value=','.join(
-                    apn.DESCRIPTOR.fields_by_name[
-                        'type'
-                    ].enum_type.values_by_number[i].name
-                    for i in self.apn.type
-                ).lower(),
-            )
-            self.add_attribute('protocol')
-            self.add_attribute('roaming_protocol')
-            self.add_attribute('carrier_enabled')
-            self.add_attribute('bearer_bitmask')
-            self.add_attribute('profile_id')
-            self.add_attribute('modem_cognitive')
-            self.add_attribute('max_conns')
-            self.add_attribute('wait_time')
-            self.add_attribute('max_conns_time')
-            self.add_attribute('mtu')
-            mvno = self.carrier_id.WhichOneof('mvno_data')
-            if mvno:
-                self.add_attribute(
-                    'mvno_type',
-                    value='gid' if mvno.startswith('gid') else mvno,
-                )
-                self.add_attribute(
-                    'mvno_match_data',
-                    value=getattr(self.carrier_id, mvno),
-                )
-            self.add_attribute('apn_set_id')
+    carrier_id_index = CarrierIdIndex.from_proto(carrier_id_list)
+    if cache is not None:
+        cache.put(('carrier_id_index',), carrier_id_index.to_json())
+    return carrier_id_index
+
+
+# Unfortunately, python processors like xml and lxml, as well as command-line
+# utilities like tidy, do not support the exact style used by AOSP for
+# apns-conf.xml:
+#
+#  * indent: 2 spaces
+#  * attribute indent: 4 spaces
+#  * blank lines between elements
+#  * attributes after first indented on separate lines
+#  * closing tags of multi-line elements on separate, unindented lines
+#
+# Therefore, we build the file without using an XML processor.
+
+class ApnRenderer:
+    """Render ApnItem messages as apns-conf.xml <apn> elements.
+
+    The attribute order, enum name tables and formatting rules are resolved
+    from the ApnItem descriptor once, into plans of (prefix, field, format)
+    steps. Rendering an APN is then a single pass over its set fields.
+    """
+
+    def __init__(self, carrier_id_index):
+        self.carrier_id_index = carrier_id_index
+        self.type_names = {
+            value.number: value.name.lower()
+            for value in ApnItem.DESCRIPTOR.fields_by_name['type'].enum_type.values
+        }
+        self.plan_before_type = self.compile_plan([
+            ('apn', 'value'),
+            ('proxy', 'proxy'),
+            ('port', 'port'),
+            ('mmsc', 'mmsc'),
+            ('mmsproxy', 'mmsc_proxy'),
+            ('mmsport', 'mmsc_proxy_port'),
+            ('user', 'user'),
+            ('password', 'password'),
+            ('server', 'server'),
+            ('authtype', 'authtype'),
+        ])
+        self.plan_before_mvno = self.compile_plan([
+            ('protocol', 'protocol'),
+            ('roaming_protocol', 'roaming_protocol'),
+            ('carrier_enabled', 'carrier_enabled'),
+            ('bearer_bitmask', 'bearer_bitmask'),
+            ('profile_id', 'profile_id'),
+            ('modem_cognitive', 'modem_cognitive'),
+            ('max_conns', 'max_conns'),
+            ('wait_time', 'wait_time'),
+            ('max_conns_time', 'max_conns_time'),
+            ('mtu', 'mtu'),
+        ])
+        self.plan_after_mvno = self.compile_plan([
+            ('apn_set_id', 'apn_set_id'),
             # No source for integer carrier_id?
-            self.add_attribute('skip_464xlat')
-            self.add_attribute('user_visible')
-            self.add_attribute('user_editable')
+            ('skip_464xlat', 'skip_464xlat'),
+            ('user_visible', 'user_visible'),
+            ('user_editable', 'user_editable'),
+        ])
 
-    if apns_folder is not None:
-        with open(os.path.join(apns_folder, 'apns-conf.xml'), 'w', encoding='utf-8') as f:
-            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n\n')
-            f.write('<apns version="8">\n\n')
-
-            for entry in carrier_list.entry:
-                try:
-                    setting = all_settings[entry.canonical_name]
-                except KeyError:
-                    print("Skipping " + entry.canonical_name, file=sys.stderr)
-                    continue
-                for apn in setting.apns.apn:
-                    f.write('  <apn carrier={}\n'.format(quoteattr(apn.name)))
-                    apn_element = ApnElement(apn, entry.carrier_id[0])
-                    for (key, value) in apn_element.attributes.items():
-                        f.write('      {}={}\n'.format(escape(key), quoteattr(value)))
-                    f.write('  />\n\n')
-
-            f.write('</apns>\n')
-
-        # Test XML parsing.
-        ET.parse(os.path.join(apns_folder, 'apns-conf.xml'))
-
-    for entry in carrier_list.entry:
-        try:
-            setting = all_settings[entry.canonical_name]
-        except KeyError:
-            print("Skipping " + entry.canonical_name, file=sys.stderr)
-            continue
-
-        carrier_config_element = ET.SubElement(
-            carrier_config_root,
-            'carrier_config',
+    @staticmethod
+    def compile_plan(attributes):
+        plan = []
+        for key, field in attributes:
+            descriptor = ApnItem.DESCRIPTOR.fields_by_name[field]
+            if key == 'skip_464xlat':
+                format_value = {
+                    value.number: quoteattr(str(value.number - 1))
+                    for value in descriptor.enum_type.values
+                }.__getitem__
+            elif descriptor.enum_type is not None:
+                format_value = {
+                    value.number: quoteattr(value.name)
+                    for value in descriptor.enum_type.values
+                }.__getitem__
+            elif descriptor.type == descriptor.TYPE_BOOL:
+                format_value = {False: '"false"', True: '"true"'}.__getitem__
+            elif descriptor.type == descriptor.TYPE_STRING:
+                format_value = quoteattr
+            else:
+                format_value = lambda value: '"{}"'.format(value)
+            plan.append(('      {}='.format(escape(key)), field, format_value))
+        return plan
+
+    def attribute(self, key, value):
+        return '      {}={}\n'.format(escape(key), quoteattr(value))
+
+    def render(self, carrier_id, apns):
+        # Attributes derived from the carrier are the same for all its APNs
+        carrier_attributes = []
+        canonical_id = self.carrier_id_index.lookup(
+            carrier_id.mcc_mnc,
+            imsi=carrier_id.imsi,
+            spn=carrier_id.spn,
+            gid1=carrier_id.gid1,
         )
+        if canonical_id is not None:
+            carrier_attributes.append(self.attribute('carrier_id', str(canonical_id)))
+        carrier_attributes.append(self.attribute('mcc', carrier_id.mcc_mnc[:3]))
+        carrier_attributes.append(self.attribute('mnc', carrier_id.mcc_mnc[3:]))
+        carrier_attributes = ''.join(carrier_attributes)
+        mvno_attributes = ''
+        mvno = carrier_id.WhichOneof('mvno_data')
+        if mvno:
+            mvno_attributes = (
+                self.attribute('mvno_type', 'gid' if mvno.startswith('gid') else mvno) +
+                self.attribute('mvno_match_data', getattr(carrier_id, mvno))
+            )
+
+        type_names = self.type_names
+        out = []
+        write = out.append
+        for apn in apns:
+            values = {field.name: value for field, value in apn.ListFields()}
+            write('  <apn carrier=')
+            write(quoteattr(apn.name))
+            write('\n')
+            write(carrier_attributes)
+            for prefix, field, format_value in self.plan_before_type:
+                if field in values:
+                    write(prefix + format_value(values[field]) + '\n')
+            write('      type="')
+            write(','.join(type_names[i] for i in apn.type))
+            write('"\n')
+            for prefix, field, format_value in self.plan_before_mvno:
+                if field in values:
+                    write(prefix + format_value(values[field]) + '\n')
+            write(mvno_attributes)
+            for prefix, field, format_value in self.plan_after_mvno:
+                if field in values:
+                    write(prefix + format_value(values[field]) + '\n')
+            write('  />\n\n')
+        return ''.join(out)
+
+
+@lru_cache(maxsize=None)
+def load_apn_renderer(carrier_id_filename, cache=None):
+    carrier_id_index = load_carrier_id_index(carrier_id_filename, cache)
+    with profiler.phase('apn_renderer'):
+        return ApnRenderer(carrier_id_index)
+
+
+def render_apns(entry, setting, apn_renderer):
+    with profiler.phase('apns'):
+        return apn_renderer.render(entry.carrier_id[0], setting.apns.apn)
+
+
+def render_apn_fragment(carrier_id_filename, cache, entry, setting, configs):
+    return render_apns(entry, setting,
+                       load_apn_renderer(carrier_id_filename, cache))
+
+
+def count_config(config):
+    """Return how many configs a config stands for, including those of its
+    bundle, and how deeply its bundles are nested.
+    """
+    if config.WhichOneof('value') != 'bundle':
+        return 1, 0
+    configs, depth = count_configs(config.bundle)
+    return configs + 1, depth + 1
+
+
+def count_configs(carrier_config):
+    """Return how many configs a CarrierConfig holds, including those of its
+    bundles, and how deeply its bundles are nested.
+    """
+    configs = 0
+    depth = 0
+    for config in carrier_config.config:
+        config_configs, config_depth = count_config(config)
+        configs += config_configs
+        depth = max(depth, config_depth)
+    return configs, depth
+
+
+# Most distinct configs whose XML a ConfigInterner keeps, and whose hashes it
+# remembers to find the configs seen more than once
+INTERNED_CONFIGS = 4096
+SEEN_CONFIGS = 65536
+
+
+class ConfigInterner:
+    """Render each carrier config seen more than once a single time.
+
+    Configs such as GPS settings or signal thresholds are shared by many
+    carriers. The hash of the serialization of each config is remembered, and
+    a config seen again is rendered to the element extract_elements() makes of
+    it, indented as a child of <carrier_config>, and kept for the carriers
+    that follow. Configs seen once are rendered with the rest of their carrier
+    instead. Both tables are bounded, dropping the least recently used XML and
+    the oldest hashes, so memory use does not grow with the number of
+    carriers. The configs and bytes looked up, and how many of them were not
+    already rendered, are counted in interner_stats.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.rendered = OrderedDict()
+        self.seen = OrderedDict()
+
+    def decode(self, data):
+        with profiler.phase('decode'):
+            return CarrierConfig.Config.FromString(data)
+
+    def lookup(self, data):
+        """Return the XML of a serialized config, or None if it is left out,
+        along with its counts and bundle depth, as render_carrier_configs()
+        counts them. Returns None instead for configs seen for the first time.
+        """
+        interner_stats['configs'] += 1
+        interner_stats['bytes'] += len(data)
+        rendered = self.rendered.get(data)
+        if rendered is not None:
+            self.rendered.move_to_end(data)
+            return rendered
+        interner_stats['unique_configs'] += 1
+        interner_stats['unique_bytes'] += len(data)
+        key = hash(data)
+        if key not in self.seen:
+            self.seen[key] = None
+            if len(self.seen) > SEEN_CONFIGS:
+                self.seen.popitem(last=False)
+            return None
+        rendered = self.rendered[data] = self.render_config(self.decode(data))
+        if len(self.rendered) > INTERNED_CONFIGS:
+            self.rendered.popitem(last=False)
+        return rendered
+
+    def render_config(self, config):
+        parent = ET.Element('carrier_config')
+        hits = Counter()
+        extract_elements(parent, config, self.rules, hits)
+        xml = None
+        if len(parent):
+            element = parent[0]
+            with profiler.phase('indent'):
+                indent(element, 2)
+            element.tail = None
+            with profiler.phase('serialize'):
+                xml = ET.tostring(element, encoding='unicode')
+        counts = {'rule:' + name: count for name, count in hits.items()}
+        counts['configs'], bundle_depth = count_config(config)
+        return xml, counts, bundle_depth
+
+
+@lru_cache(maxsize=None)
+def load_config_interner(rules):
+    return ConfigInterner(rules)
+
+
+# Serialized stand-in for the XML of an interned config
+INTERNED_PLACEHOLDER = re.compile(r'<interned-(\d+) />')
+
+
+def render_carrier_configs(entry, setting, configs, rules=config_rules):
+    """Return the vendor.xml and vendor_no_sim.xml fragments of a carrier.
+
+    configs are the serialized configs of the carrier. Those the
+    ConfigInterner of rules has rendered are inserted as they are and the
+    others are rendered with the rest of the carrier. The vendor_no_sim.xml
+    fragment is None unless the carrier is the no SIM carrier (MCC and MNC
+    000). The third item counts the APNs and configs of the carrier, the
+    nesting depth of its bundles and, as 'rule:<name>', the vendor.xml configs
+    left out by each rule.
+    """
+    interner = load_config_interner(rules)
+    counts = Counter()
+    hits = Counter()
+    bundle_depth = 0
+    with profiler.phase('carrier_config'):
+        carrier_config_element = ET.Element('carrier_config')
+        carrier_config_no_sim_fragment = None
         mcc = entry.carrier_id[0].mcc_mnc[:3]
         mnc = entry.carrier_id[0].mcc_mnc[3:]
         if (mcc == '000' and mnc == '000'):
-            carrier_config_no_sim_element = ET.SubElement(
-                carrier_config_no_sim_root,
-                'carrier_config',
-            )
-            for config in setting.configs.config:
-                extract_gps_elements(carrier_config_no_sim_element, config)
+            carrier_config_no_sim_element = ET.Element('carrier_config')
+            for config in configs:
+                extract_gps_elements(carrier_config_no_sim_element,
+                                     interner.decode(config), rules, Counter())
+            carrier_config_no_sim_fragment = \
+                carrier_config_fragment(carrier_config_no_sim_element)
         else:
             carrier_config_element.set('mcc', mcc)
             carrier_config_element.set('mnc', mnc)
@@ -379,21 +653,486 @@ def main():
                     field,
                     getattr(entry.carrier_id[0], field),
                 )
-        for config in setting.configs.config:
-            extract_elements(carrier_config_element, config)
-
-    indent(carrier_config_root)
-    carrier_config_tree = ET.ElementTree(carrier_config_root)
-    carrier_config_tree.write(os.path.join(vendor_folder, 'vendor.xml'),
-                              encoding='utf-8', xml_declaration=True)
-    indent(carrier_config_no_sim_root)
-    carrier_config_no_sim_tree = ET.ElementTree(carrier_config_no_sim_root)
-    carrier_config_no_sim_tree.write(os.path.join(vendor_folder, 'vendor_no_sim.xml'),
-                              encoding='utf-8', xml_declaration=True)
-
-    # Test XML parsing.
-    ET.parse(os.path.join(vendor_folder, 'vendor.xml'))
-    ET.parse(os.path.join(vendor_folder, 'vendor_no_sim.xml'))
+        interned = []
+        for config in configs:
+            rendered = interner.lookup(config)
+            if rendered is None:
+                config = interner.decode(config)
+                extract_elements(carrier_config_element, config, rules, hits)
+                config_configs, config_bundle_depth = count_config(config)
+                counts['configs'] += config_configs
+            else:
+                xml, config_counts, config_bundle_depth = rendered
+                if xml is not None:
+                    ET.SubElement(carrier_config_element,
+                                  'interned-{}'.format(len(interned)))
+                    interned.append(xml)
+                counts.update(config_counts)
+            bundle_depth = max(bundle_depth, config_bundle_depth)
+        carrier_config_xml = carrier_config_fragment(carrier_config_element)
+        if interned:
+            carrier_config_xml = INTERNED_PLACEHOLDER.sub(
+                lambda match: interned[int(match.group(1))], carrier_config_xml)
+    counts.update({'rule:' + name: count for name, count in hits.items()})
+    counts.update(apns=len(setting.apns.apn))
+    counts['bundle_depth'] = bundle_depth
+    return (carrier_config_xml,
+            carrier_config_no_sim_fragment,
+            dict(counts))
+
+
+# Renderers of the process forking the render_shard() workers
+render_worker_renderers = None
+
+
+def init_render_worker(renderers):
+    global render_worker_renderers
+    render_worker_renderers = renderers
+
+
+def render_shard(shard):
+    """Render the fragments of a list of (entry, serialized settings) pairs.
+
+    Returns the fragments of each carrier, the wall and CPU time taken and
+    what was added to interner_stats.
+    """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    stats = Counter(interner_stats)
+    fragments = []
+    for entry, data in shard:
+        setting, configs = split_configs(data)
+        fragments.append([render(entry, setting, configs)
+                          for _, render in render_worker_renderers])
+    return (fragments, time.perf_counter() - wall, time.process_time() - cpu,
+            interner_stats - stats)
+
+
+# Carriers per shard rendered by a render_shard() worker
+SHARD_SIZE = 32
+
+
+def render_sharded(all_settings, entries, renderers, jobs):
+    """Yield the fragments of each entry, rendering them in worker processes.
+
+    Entries are taken SHARD_SIZE at a time, and those missing a fragment are
+    rendered as one shard by one of jobs forked processes. Shards are
+    collected in order, so the fragments come out in the same order as when
+    rendered one by one. Only two shards per process are submitted ahead of
+    the one being collected, so the carriers read and the fragments found
+    for them are bounded by the shards in flight rather than by the folder.
+    The time taken by each shard is printed to stderr.
+    """
+    entries = iter(entries)
+    in_flight = deque()
+    shard_index = 0
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=init_render_worker,
+            initargs=(renderers,)) as executor:
+
+        def submit():
+            """Look up the fragments of the next entries and submit those
+            missing any. Returns False once there are no entries left.
+            """
+            found = []
+            pending = []
+            for entry in islice(entries, SHARD_SIZE):
+                keys = [all_settings.fragment_key(kind, entry)
+                        for kind, _ in renderers]
+                fragments = [all_settings.find_fragment(key) for key in keys]
+                if None in fragments:
+                    pending.append((entry, all_settings.raw(entry.canonical_name)))
+                found.append((keys, fragments))
+            if not found:
+                return False
+            future = executor.submit(render_shard, pending) if pending else None
+            in_flight.append((found, future))
+            return True
+
+        while len(in_flight) < jobs * 2 and submit():
+            pass
+        while in_flight:
+            found, future = in_flight.popleft()
+            rendered = iter(())
+            if future is not None:
+                with profiler.phase('shards'):
+                    fragments, wall, cpu, stats = future.result()
+                profiler.add_shard(len(fragments), wall, cpu)
+                interner_stats.update(stats)
+                print("Shard {}: rendered {} carriers in {:.3f}s ({:.3f}s CPU)".format(
+                    shard_index, len(fragments), wall, cpu), file=sys.stderr)
+                shard_index += 1
+                rendered = iter(fragments)
+            # Keep the workers busy while this shard is written
+            submit()
+            for keys, fragments in found:
+                new_fragments = None
+                if None in fragments:
+                    new_fragments = next(rendered)
+                for i, key in enumerate(keys):
+                    if fragments[i] is None:
+                        fragments[i] = new_fragments[i]
+                        all_settings.store_fragment(key, fragments[i], True)
+                    else:
+                        all_settings.store_fragment(key, fragments[i], False)
+                yield fragments
+
+
+def available_cpus():
+    """Return the number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def fragment_renderers(apns, carrier_configs,
+                       carrier_id_filename=carrier_id_database, cache=None,
+                       rules=config_rules):
+    """Return the (kind, render) pairs rendering the apns-conf.xml fragment of
+    a carrier if apns and its vendor.xml fragments if carrier_configs.
+    """
+    renderers = []
+    if apns:
+        renderers.append(('apns', partial(render_apn_fragment,
+                                          carrier_id_filename, cache)))
+    if carrier_configs:
+        renderers.append(('carrier_config:' + rules.digest,
+                          partial(render_carrier_configs, rules=rules)))
+    return renderers
+
+
+def write_carrier_files(carrier_list, all_settings, apns_filename=None,
+                        vendor_folder=None,
+                        carrier_id_filename=carrier_id_database, cache=None,
+                        validate=False, rules=config_rules, jobs=1):
+    """Write apns-conf.xml to apns_filename and vendor.xml and vendor_no_sim.xml
+    to vendor_folder, skipping either when None.
+
+    Carriers are rendered for every output in a row, so that each of them is
+    parsed once, and with more than one job in worker processes. jobs is capped
+    to the available CPUs, as extra processes would only add the cost of
+    forking and of sending the fragments back. Returns the number of carriers
+    written and the totals of the counts returned by render_carrier_configs(),
+    except for the bundle depth, which is the deepest of all carriers.
+    """
+    renderers = fragment_renderers(apns_filename is not None,
+                                   vendor_folder is not None,
+                                   carrier_id_filename, cache, rules)
+
+    counts = Counter()
+    with ExitStack() as stack:
+        apns_file = None
+        if apns_filename is not None:
+            apns_file = stack.enter_context(XMLOutputFile(apns_filename, validate))
+            apns_file.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n\n')
+            apns_file.write('<apns version="8">\n\n')
+        vendor_writer = None
+        if vendor_folder is not None:
+            vendor_writer = stack.enter_context(CarrierConfigListWriter(
+                os.path.join(vendor_folder, 'vendor.xml'), validate))
+            no_sim_writer = stack.enter_context(CarrierConfigListWriter(
+                os.path.join(vendor_folder, 'vendor_no_sim.xml'), validate))
+
+        entries = []
+        for entry in carrier_list.entry:
+            if entry.canonical_name not in all_settings:
+                print("Skipping " + entry.canonical_name, file=sys.stderr)
+                continue
+            entries.append(entry)
+
+        jobs = min(jobs, available_cpus())
+        if jobs > 1:
+            if apns_filename is not None:
+                # Load the APN renderer once, for the workers to inherit
+                load_apn_renderer(carrier_id_filename, cache)
+            all_fragments = render_sharded(all_settings, entries, renderers, jobs)
+        else:
+            all_fragments = (
+                [all_settings.cached_fragment(kind, entry, partial(render, entry))
+                 for kind, render in renderers]
+                for entry in entries
+            )
+
+        for entry, fragments in zip(entries, all_fragments):
+            fragments = iter(fragments)
+            if apns_file is not None:
+                apns_file.write(next(fragments), entry.canonical_name)
+            if vendor_writer is not None:
+                vendor_fragment, no_sim_fragment, carrier_counts = next(fragments)
+                bundle_depth = max(counts['bundle_depth'],
+                                   carrier_counts['bundle_depth'])
+                counts.update(carrier_counts)
+                counts['bundle_depth'] = bundle_depth
+                if no_sim_fragment is not None:
+                    no_sim_writer.write(no_sim_fragment, entry.canonical_name)
+                vendor_writer.write(vendor_fragment, entry.canonical_name)
+
+        if apns_file is not None:
+            apns_file.write('</apns>\n')
+    counts['carriers'] = len(entries)
+    return counts
+
+
+def open_extraction_cache(cache_dir, max_size,
+                          carrier_id_filename=carrier_id_database):
+    # Changes to the extractor, to the modules it renders and decodes carriers
+    # with, including the generated protobuf modules whose descriptors name
+    # the APN types, or to the carrier ID database invalidate every cached
+    # fragment.
+    return ExtractionCache(cache_dir, max_size,
+                           salt=[file_digest(__file__),
+                                 file_digest(inspect.getfile(CarrierIdIndex)),
+                                 file_digest(inspect.getfile(ConfigRules)),
+                                 file_digest(inspect.getfile(split_configs)),
+                                 file_digest(inspect.getfile(ApnItem)),
+                                 file_digest(inspect.getfile(CarrierIdList)),
+                                 file_digest(carrier_id_filename)])
+
+
+def extract(input_folder, apns_folder, vendor_folder, cache=None, jobs=1,
+            validate='stream', carrier_id_filename=carrier_id_database,
+            payloads=None, rules=config_rules):
+    """Convert one CarrierSettings folder to AOSP XML files.
+
+    apns-conf.xml is written to apns_folder and vendor.xml and
+    vendor_no_sim.xml to vendor_folder, unless either is None. jobs is the
+    number of processes used to render the carriers and validate one of
+    'stream', 'full' or 'off'.
+    Returns how many fragments were rendered and reused, along with the counts
+    of write_carrier_files() and, as 'interned:<name>', what was added to
+    interner_stats.
+    """
+    carrier_list = load_carrier_list(input_folder, profiler)
+    apns_filename = None
+    if apns_folder is not None:
+        apns_filename = os.path.join(apns_folder, 'apns-conf.xml')
+
+    with profiler.phase('index'):
+        all_settings = CarrierSettingsLoader(input_folder, cache, payloads,
+                                             profiler=profiler)
+    interned = Counter(interner_stats)
+    with all_settings:
+        all_settings.stats.update(write_carrier_files(
+            carrier_list, all_settings, apns_filename, vendor_folder,
+            carrier_id_filename, cache, validate == 'stream', rules, jobs))
+    all_settings.stats.update({'interned:' + name: count for name, count
+                               in (interner_stats - interned).items()})
+    # Start over with the next extraction, e.g. of a watched folder
+    load_config_interner.cache_clear()
+
+    if validate == 'full':
+        with profiler.phase('validate_full'):
+            if apns_filename is not None:
+                ET.parse(apns_filename)
+            if vendor_folder is not None:
+                ET.parse(os.path.join(vendor_folder, 'vendor.xml'))
+                ET.parse(os.path.join(vendor_folder, 'vendor_no_sim.xml'))
+
+    return all_settings.stats
+
+
+# Payloads of the process forking the extract_all() workers
+worker_payloads = None
+
+
+def init_extract_worker(payloads):
+    global worker_payloads
+    worker_payloads = payloads
+
+
+def extract_worker(job, **kwargs):
+    return extract(*job, payloads=worker_payloads, **kwargs)
+
+
+def render_payloads(input_folder, apns, carrier_configs, payloads, jobs,
+                    cache=None, carrier_id_filename=carrier_id_database,
+                    rules=config_rules):
+    """Render the fragments of one CarrierSettings folder into payloads with
+    jobs worker processes, without writing any file.
+
+    Fragments already in payloads or in the cache are not rendered again.
+    Returns how many fragments were rendered and reused.
+    """
+    carrier_list = load_carrier_list(input_folder, profiler)
+    renderers = fragment_renderers(apns, carrier_configs, carrier_id_filename,
+                                   cache, rules)
+    with CarrierSettingsLoader(input_folder, cache, payloads, quiet=True,
+                               profiler=profiler) as all_settings:
+        entries = [entry for entry in carrier_list.entry
+                   if entry.canonical_name in all_settings]
+        for _ in render_sharded(all_settings, entries, renderers, jobs):
+            pass
+    return all_settings.stats
+
+
+def extract_all(extract_jobs, workers=None, cache=None, validate='stream',
+                carrier_id_filename=carrier_id_database, rules=config_rules):
+    """Convert several CarrierSettings folders, e.g. one per device.
+
+    extract_jobs is a list of (input folder, apns folder, vendor folder)
+    tuples, as taken by extract(). The carrier ID database is decoded once and
+    identical CarrierSettings files, which most devices built from the same
+    release share, are decoded and rendered once.
+
+    With more than one worker, which defaults to one per available CPU, this
+    happens in two steps. The fragments of every job are first rendered into
+    a PayloadStore, folder by folder with render_payloads(), so that each
+    unique fragment is rendered once by one of the workers. The jobs are then
+    run concurrently by up to workers forked processes, which inherit the
+    decoded carrier ID database, the imported protobuf descriptors and all
+    fragments, and only have to write them. With one worker, the jobs are run
+    one by one in this process, sharing their fragments likewise. The cache,
+    if any, is pruned once all jobs are done.
+    """
+    load_apn_renderer(carrier_id_filename, cache)
+    extract_jobs = list(extract_jobs)
+    payloads = PayloadStore()
+    options = {
+        'cache': cache,
+        'validate': validate,
+        'carrier_id_filename': carrier_id_filename,
+        'rules': rules,
+    }
+    workers = min(workers or available_cpus(), available_cpus())
+    stats = Counter()
+    if workers == 1 or len(extract_jobs) <= 1:
+        for job in extract_jobs:
+            stats.update(extract(*job, payloads=payloads, jobs=workers,
+                                 **options))
+    else:
+        rendered = Counter()
+        for input_folder, apns_folder, vendor_folder in extract_jobs:
+            rendered.update(render_payloads(
+                input_folder, apns_folder is not None, vendor_folder is not None,
+                payloads, workers, cache, carrier_id_filename, rules))
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=init_extract_worker,
+                initargs=(payloads,)) as executor:
+            futures = [executor.submit(extract_worker, job, **options)
+                       for job in extract_jobs]
+            for future in futures:
+                stats.update(future.result())
+        # Every fragment the jobs wrote was rendered or reused beforehand
+        stats['reused'] += stats['rendered'] - rendered['rendered']
+        stats['rendered'] = rendered['rendered']
+    if cache is not None:
+        cache.prune()
+    print_payload_summary(payloads)
+    print("Rendered {} carrier fragments, reused {}".format(
+        stats['rendered'], stats['reused']), file=sys.stderr)
+
+
+def print_payload_summary(payloads):
+    """Print how many of the files loaded into payloads were shared."""
+    files = sum(len(folders) for folders in payloads.files.values())
+    shared = sum(1 for folders in payloads.files.values() if len(folders) > 1)
+    print("Loaded {} CarrierSettings files: {} unique, {} shared between folders".format(
+        files, len(payloads.files), shared), file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+
+    if args.diff is not None:
+        from carriersettings_diff import diff_folders, format_diff
+        diff = diff_folders(*args.diff)
+        if args.diff_format == 'json':
+            json.dump(diff, sys.stdout, indent=2, ensure_ascii=False)
+            print()
+        else:
+            print(format_diff(diff))
+        return
+
+    if args.sqlite is not None:
+        from carriersettings_sqlite import export_sqlite
+        counts = export_sqlite(args.input, args.sqlite)
+        print("Exported {carriers} carriers, {carrier_ids} carrier IDs, {apns} APNs "
+              "and {configs} configs to {filename}".format(filename=args.sqlite, **counts),
+              file=sys.stderr)
+        return
+
+    if args.add_snapshot is not None or args.history is not None:
+        from carriersettings_archive import Archive
+        with Archive(args.archive) as archive:
+            if args.add_snapshot is not None:
+                counts = archive.add(args.add_snapshot, args.input)
+                print("Archived {files} files as {name}: {blobs} blobs, "
+                      "{new_blobs} of them new".format(name=args.add_snapshot,
+                                                       **counts),
+                      file=sys.stderr)
+            else:
+                for snapshot, value_type, value in archive.history(*args.history):
+                    if value_type is None:
+                        value = '-'
+                    elif value_type not in ('text_array', 'int_array'):
+                        # Arrays are already stored as JSON
+                        value = json.dumps(value, ensure_ascii=False)
+                    print('{}\t{}'.format(snapshot, value))
+        return
+
+    global profiler
+    if args.profile is not None or args.cprofile is not None:
+        profiler = Profiler(cprofile=args.cprofile is not None)
+
+    cache = None
+    if not args.no_cache:
+        cache = open_extraction_cache(args.cache_dir,
+                                      args.cache_size * 1024 * 1024)
+
+    rules = config_rules
+    if args.rules != config_rules_file:
+        rules = ConfigRules.load(args.rules)
+
+    if args.watch is not None:
+        from carriersettings_watch import watch
+        try:
+            watch(extract, args.input, args.apns, args.vendor, args.watch,
+                  cache, jobs=args.jobs, validate=args.validate, rules=rules)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    with ExitStack() as stack:
+        input_folder = args.input
+        if args.snapshot is not None:
+            from carriersettings_archive import Archive
+            input_folder = stack.enter_context(tempfile.TemporaryDirectory(
+                prefix='carriersettings-'))
+            with profiler.phase('checkout'), Archive(args.archive) as archive:
+                archive.checkout(args.snapshot, input_folder)
+        stats = extract(input_folder, args.apns, args.vendor, cache, args.jobs,
+                        args.validate, rules=rules)
+
+    if args.rule_stats:
+        for name in rules.names:
+            print("{}: {} configs left out".format(name, stats['rule:' + name]),
+                  file=sys.stderr)
+
+    if cache is not None:
+        with profiler.phase('cache'):
+            cache.prune()
+
+    if args.cprofile is not None:
+        phase = profiler.dump_cprofile(args.cprofile)
+        print("Saved the profile of the {} phase to {}".format(phase, args.cprofile),
+              file=sys.stderr)
+    if args.profile is not None:
+        counts = {key: stats[key] for key in ('carriers', 'apns', 'configs',
+                                              'bundle_depth', 'rendered', 'reused')}
+        counts['filtered'] = {name: stats['rule:' + name] for name in rules.names}
+        counts['interned'] = {
+            name: stats['interned:' + name]
+            for name in ('configs', 'unique_configs', 'bytes', 'unique_bytes')}
+        # How many configs were looked up for each one not already rendered
+        counts['interned']['dedup_ratio'] = (
+            stats['interned:configs'] / stats['interned:unique_configs']
+            if stats['interned:unique_configs'] else None)
+        profiler.write(args.profile, counts)
 
 if __name__ == '__main__':
     main()
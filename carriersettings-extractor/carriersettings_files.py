@@ -0,0 +1,296 @@
+from collections import Counter
+from glob import glob
+import hashlib
+import mmap
+import os
+import sys
+
+from google.protobuf.message import DecodeError
+
+from carrier_list_pb2 import CarrierList
+from carrier_settings_pb2 import CarrierSettings
+from carriersettings_profile import NullProfiler
+
+
+def read_varint(buffer, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buffer):
+            raise DecodeError('Truncated varint')
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(buffer, pos, end):
+    """Yield the (number, wire type, start, end, field start) of the fields
+    of a message.
+
+    start and end delimit the value of the field, without its tag and, for
+    length-delimited fields, without its length, while the field itself starts
+    at field start.
+    """
+    while pos < end:
+        field_start = pos
+        tag, pos = read_varint(buffer, pos)
+        wire_type = tag & 7
+        if wire_type == 0:
+            _, next_pos = read_varint(buffer, pos)
+        elif wire_type == 1:
+            next_pos = pos + 8
+        elif wire_type == 2:
+            length, pos = read_varint(buffer, pos)
+            next_pos = pos + length
+        elif wire_type == 5:
+            next_pos = pos + 4
+        else:
+            raise DecodeError('Unsupported wire type {}'.format(wire_type))
+        if next_pos > end:
+            raise DecodeError('Truncated message')
+        yield tag >> 3, wire_type, pos, next_pos, field_start
+        pos = next_pos
+
+
+def read_canonical_name(buffer, start, end):
+    """Return the canonical_name of the CarrierSettings in buffer[start:end]."""
+    name = ''
+    for number, wire_type, value_start, value_end, _ in iter_fields(buffer, start, end):
+        # canonical_name is field 1; like the parser, keep the last occurrence
+        if number == 1 and wire_type == 2:
+            name = bytes(buffer[value_start:value_end]).decode('utf-8')
+    return name
+
+
+def split_configs(data):
+    """Split serialized CarrierSettings into the CarrierSettings without its
+    configs and the list of its serialized CarrierConfig.Config messages.
+    """
+    rest = []
+    configs = []
+    for number, wire_type, start, end, field_start in iter_fields(data, 0, len(data)):
+        # CarrierSettings.configs is field 4 and CarrierConfig.config field 2
+        if number == 4 and wire_type == 2:
+            configs.extend(
+                data[config_start:config_end]
+                for config_number, config_wire_type, config_start, config_end, _
+                in iter_fields(data, start, end)
+                if config_number == 2 and config_wire_type == 2)
+        else:
+            rest.append(data[field_start:end])
+    return CarrierSettings.FromString(b''.join(rest)), configs
+
+
+class SettingsFile:
+    """A memory-mapped CarrierSettings file, indexed by canonical name.
+
+    Opening the file only walks the wire format far enough to find where each
+    CarrierSettings message starts and ends and what its canonical_name is.
+    Messages are parsed by parse() or split(), one at a time, and not kept.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty files cannot be mapped
+                self.buffer = b''
+        self.spans = {}
+        if os.path.basename(filename) == 'others.pb':
+            # MultiCarrierSettings.setting is field 2
+            for number, wire_type, start, end, _ in iter_fields(self.buffer, 0, len(self.buffer)):
+                if number == 2 and wire_type == 2:
+                    self.spans[read_canonical_name(self.buffer, start, end)] = (start, end)
+        else:
+            self.spans[read_canonical_name(self.buffer, 0, len(self.buffer))] = \
+                (0, len(self.buffer))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def names(self):
+        return list(self.spans)
+
+    def raw(self, name):
+        start, end = self.spans[name]
+        return self.buffer[start:end]
+
+    def parse(self, name):
+        return CarrierSettings.FromString(self.raw(name))
+
+    def split(self, name):
+        return split_configs(self.raw(name))
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_carrier_list(input_folder, profiler=NullProfiler()):
+    carrier_list = CarrierList()
+    with profiler.phase('carrier_list'), \
+            open(os.path.join(input_folder, 'carrier_list.pb'), 'rb') as pb:
+        carrier_list.ParseFromString(pb.read())
+    return carrier_list
+
+
+def settings_filenames(input_folder):
+    """Return the CarrierSettings files of a folder, in loading order.
+
+    Generic settings from others.pb are loaded first and carrier specific files
+    last, to allow overriding generic settings.
+    """
+    return [os.path.join(input_folder, 'others.pb')] + [
+        filename for filename in glob(os.path.join(input_folder, '*.pb'))
+        # carrier_list.pb does not hold CarrierSettings
+        if os.path.basename(filename) not in ('carrier_list.pb', 'others.pb')
+    ]
+
+
+def payload_key(filename, digest):
+    # others.pb is indexed differently from the other files
+    return (os.path.basename(filename) == 'others.pb', digest)
+
+
+class CarrierSettingsLoader:
+    """Map canonical names to the CarrierSettings found in the input folder.
+
+    Input files are memory-mapped and indexed by canonical name up front, but
+    settings are only parsed when they are requested and are not kept, so
+    memory use grows with the largest carrier rather than with the folder.
+    Carriers are rendered from split(), which leaves their configs serialized
+    for the ConfigInterner. The last carrier split is remembered, so that
+    rendering all outputs of a carrier in a row splits it once.
+
+    Rendered fragments are looked up with cached_fragment(), which also counts
+    how many were rendered and how many were reused in stats. With a
+    PayloadStore, fragments rendered from a file identical to one loaded
+    earlier, e.g. for another device, are reused, and the folder each file is
+    loaded from is recorded in its files. Unless quiet, the carriers
+    whose generic settings are overridden are printed to stderr. Decoding and
+    cache lookups are timed by profiler.
+    """
+
+    def __init__(self, input_folder, cache=None, payloads=None, quiet=False,
+                 profiler=NullProfiler()):
+        filenames = settings_filenames(input_folder)
+        self.cache = cache
+        self.profiler = profiler
+        self.payloads = payloads
+        self.files = {}
+        self.digests = {}
+        self.last = None
+        self.stats = Counter()
+        for filename in filenames:
+            self.files[filename] = SettingsFile(filename)
+            if cache is not None or payloads is not None:
+                self.digests[filename] = hashlib.sha256(
+                    self.files[filename].buffer).hexdigest()
+            if payloads is not None:
+                payloads.files.setdefault(
+                    payload_key(filename, self.digests[filename]),
+                    set()).add(input_folder)
+
+        # Files are merged in glob order, so that overrides and their
+        # diagnostics are deterministic.
+        self.sources = {}
+        for filename in filenames:
+            for name in self.files[filename].names():
+                if self.sources.get(name, filename) != filename and not quiet:
+                    print("Overriding generic settings for " + name, file=sys.stderr)
+                self.sources[name] = filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __getitem__(self, name):
+        with self.profiler.phase('decode'):
+            return self.files[self.sources[name]].parse(name)
+
+    def split(self, name):
+        """Return the CarrierSettings of a carrier without its configs, and
+        its serialized configs.
+        """
+        if self.last is None or self.last[0] != name:
+            with self.profiler.phase('decode'):
+                self.last = (name, self.files[self.sources[name]].split(name))
+        return self.last[1]
+
+    def raw(self, name):
+        """Return the serialized CarrierSettings of a carrier."""
+        return self.files[self.sources[name]].raw(name)
+
+    def digest(self, name):
+        return self.digests.get(self.sources[name])
+
+    def close(self):
+        self.last = None
+        for settings_file in self.files.values():
+            settings_file.close()
+
+    def fragment_key(self, kind, entry):
+        """Return the key of a fragment, or None if fragments are not kept.
+
+        Fragments are keyed by the content hash of the file the carrier
+        settings come from and by the carrier_list entry they are rendered for.
+        """
+        if self.cache is None and self.payloads is None:
+            return None
+        return (kind, self.digest(entry.canonical_name), entry.canonical_name,
+                hashlib.sha256(entry.SerializeToString()).hexdigest())
+
+    def find_fragment(self, key):
+        fragment = None
+        if key is not None and self.payloads is not None:
+            fragment = self.payloads.fragments.get(key)
+        if fragment is None and key is not None and self.cache is not None:
+            with self.profiler.phase('cache'):
+                fragment = self.cache.get(key)
+        return fragment
+
+    def store_fragment(self, key, fragment, rendered):
+        self.stats['rendered' if rendered else 'reused'] += 1
+        if key is None:
+            return
+        if rendered and self.cache is not None:
+            with self.profiler.phase('cache'):
+                self.cache.put(key, fragment)
+        if self.payloads is not None:
+            self.payloads.fragments[key] = fragment
+
+    def cached_fragment(self, kind, entry, render):
+        """Render a carrier with render(setting, configs), as returned by
+        split(), reusing earlier fragments.
+        """
+        key = self.fragment_key(kind, entry)
+        fragment = self.find_fragment(key)
+        rendered = fragment is None
+        if rendered:
+            fragment = render(*self.split(entry.canonical_name))
+        self.store_fragment(key, fragment, rendered)
+        return fragment
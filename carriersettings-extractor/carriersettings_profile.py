@@ -0,0 +1,120 @@
+from contextlib import contextmanager, nullcontext
+import cProfile
+import json
+import resource
+import time
+
+
+def max_rss_kib():
+    # ru_maxrss is in KiB on Linux and only ever grows
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class NullProfiler:
+    """Profiler that records nothing, used unless profiling is requested."""
+
+    def phase(self, name):
+        return nullcontext()
+
+    def add_shard(self, carriers, wall, cpu):
+        pass
+
+
+class Profiler:
+    """Record the wall time, CPU time and peak RSS growth of extraction phases.
+
+    The peak RSS growth of a phase is how much the peak RSS of the process
+    grew while it ran, which is where memory went, unlike the peak RSS itself,
+    which only tells when it was reached. Phases can be nested, and the time
+    spent and RSS growth in a nested phase are not counted in the enclosing
+    one, so the phases add up to those of all of them. With cprofile, every
+    phase is also profiled separately, so that the profile of the phase that
+    took longest can be saved.
+    """
+
+    def __init__(self, cprofile=False):
+        self.phases = {}
+        self.stack = []
+        self.shards = []
+        self.profiles = {} if cprofile else None
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def start(self, name):
+        if self.stack:
+            self.pause(self.stack[-1])
+        self.stack.append({'name': name, 'wall': 0.0, 'cpu': 0.0, 'rss': 0})
+        self.resume(self.stack[-1])
+
+    def stop(self):
+        frame = self.stack.pop()
+        self.pause(frame)
+        phase = self.phases.setdefault(frame['name'], {
+            'calls': 0,
+            'cpu': 0.0,
+            'wall': 0.0,
+            'peak_rss_growth_kib': 0,
+        })
+        phase['calls'] += 1
+        phase['wall'] += frame['wall']
+        phase['cpu'] += frame['cpu']
+        phase['peak_rss_growth_kib'] += frame['rss']
+        if self.stack:
+            self.resume(self.stack[-1])
+
+    def resume(self, frame):
+        frame['wall'] -= time.perf_counter()
+        frame['cpu'] -= time.process_time()
+        frame['rss'] -= max_rss_kib()
+        if self.profiles is not None:
+            self.profiles.setdefault(frame['name'], cProfile.Profile()).enable()
+
+    def pause(self, frame):
+        if self.profiles is not None:
+            self.profiles[frame['name']].disable()
+        frame['wall'] += time.perf_counter()
+        frame['cpu'] += time.process_time()
+        frame['rss'] += max_rss_kib()
+
+    def add_shard(self, carriers, wall, cpu):
+        self.shards.append({'carriers': carriers, 'wall': wall, 'cpu': cpu})
+
+    def hottest_phase(self):
+        if not self.phases:
+            return None
+        return max(self.phases, key=lambda name: self.phases[name]['wall'])
+
+    def dump_cprofile(self, filename):
+        """Save the cProfile statistics of the hottest phase and return its name."""
+        name = self.hottest_phase()
+        if name is not None:
+            self.profiles[name].dump_stats(filename)
+        return name
+
+    def report(self, counts):
+        """Return the profile as a JSON-serializable dict."""
+        return {
+            'version': 2,
+            'total': {
+                'wall': time.perf_counter() - self.wall,
+                'cpu': time.process_time() - self.cpu,
+            },
+            'phases': self.phases,
+            'shards': self.shards,
+            'counts': counts,
+            'peak_rss_kib': max_rss_kib(),
+            'children_peak_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+    def write(self, filename, counts):
+        with open(filename, 'w') as f:
+            json.dump(self.report(counts), f, indent=2, sort_keys=True)
+            f.write('\n')
@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+
+from carrier_settings_pb2 import ApnItem
+from carriersettings_diff import is_repeated
+from carriersettings_files import CarrierSettingsLoader, load_carrier_list
+
+SCHEMA_VERSION = 1
+
+# APN fields are stored in columns named after them
+apn_fields = ApnItem.DESCRIPTOR.fields
+
+SCHEMA = '''
+CREATE TABLE carriers (
+    canonical_name TEXT PRIMARY KEY,
+    version INTEGER,
+    source TEXT
+);
+CREATE TABLE carrier_ids (
+    canonical_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    mcc_mnc TEXT,
+    mcc TEXT,
+    mnc TEXT,
+    spn TEXT,
+    imsi TEXT,
+    gid1 TEXT
+);
+CREATE TABLE apns (
+    canonical_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    {apn_columns}
+);
+CREATE TABLE configs (
+    canonical_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    key TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    type TEXT,
+    value
+);
+CREATE INDEX carrier_ids_canonical_name ON carrier_ids (canonical_name);
+CREATE INDEX carrier_ids_mcc_mnc ON carrier_ids (mcc_mnc);
+CREATE INDEX apns_canonical_name ON apns (canonical_name);
+CREATE INDEX configs_canonical_name ON configs (canonical_name);
+CREATE INDEX configs_key ON configs (key, value);
+CREATE INDEX configs_path ON configs (path);
+-- APNs with the attributes apns-conf.xml takes from the carrier ID
+CREATE VIEW apn_conf AS
+SELECT apns.*, carrier_ids.mcc, carrier_ids.mnc,
+    CASE
+        WHEN carrier_ids.spn IS NOT NULL THEN 'spn'
+        WHEN carrier_ids.imsi IS NOT NULL THEN 'imsi'
+        WHEN carrier_ids.gid1 IS NOT NULL THEN 'gid'
+    END AS mvno_type,
+    COALESCE(carrier_ids.spn, carrier_ids.imsi, carrier_ids.gid1) AS mvno_match_data
+FROM apns JOIN carrier_ids USING (canonical_name)
+WHERE carrier_ids.position = 0;
+'''
+
+
+def column_type(field):
+    if not is_repeated(field) and field.cpp_type in (
+            field.CPPTYPE_INT32, field.CPPTYPE_INT64, field.CPPTYPE_UINT32,
+            field.CPPTYPE_UINT64, field.CPPTYPE_BOOL):
+        return 'INTEGER'
+    return 'TEXT'
+
+
+def apn_row(canonical_name, position, apn):
+    """Return the apns row of an APN, with enums as names and lists as JSON."""
+    row = [canonical_name, position]
+    for field in apn_fields:
+        if not is_repeated(field) and not apn.HasField(field.name):
+            row.append(None)
+            continue
+        value = getattr(apn, field.name)
+        if field.enum_type is not None:
+            names = field.enum_type.values_by_number
+            value = [names[v].name for v in value] if is_repeated(field) \
+                else names[value].name
+        if is_repeated(field):
+            value = json.dumps(list(value))
+        row.append(value)
+    return row
+
+
+def config_rows(canonical_name, carrier_config, path='', depth=0):
+    """Yield the configs rows of a CarrierConfig, including bundle contents.
+
+    Configs are identified by their path, the keys of their enclosing bundles
+    and their own key joined by slashes. Arrays are stored as JSON and bundles
+    without a value.
+    """
+    for config in carrier_config.config:
+        value_type = config.WhichOneof('value')
+        if value_type in ('text_array', 'int_array'):
+            value = json.dumps(list(getattr(config, value_type).item))
+        elif value_type in (None, 'bundle'):
+            value = None
+        else:
+            value = getattr(config, value_type)
+        yield (canonical_name, path + config.key, config.key, depth, value_type,
+               value)
+        if value_type == 'bundle':
+            yield from config_rows(canonical_name, config.bundle,
+                                   path + config.key + '/', depth + 1)
+
+
+def export_sqlite(input_folder, filename):
+    """Export a CarrierSettings folder to an SQLite database.
+
+    Every carrier of the folder is exported, whether or not carrier_list.pb
+    refers to it, with all of its configs. The database is written to a
+    temporary file which then replaces filename. Returns the number of rows
+    of each table.
+    """
+    carrier_list = load_carrier_list(input_folder)
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    db = sqlite3.connect(tmp_filename)
+    try:
+        counts = write_tables(db, input_folder, carrier_list)
+    except BaseException:
+        db.close()
+        os.remove(tmp_filename)
+        raise
+    db.close()
+    os.replace(tmp_filename, filename)
+    return counts
+
+
+def write_tables(db, input_folder, carrier_list):
+    db.executescript(SCHEMA.format(apn_columns=',\n    '.join(
+        '"{}" {}'.format(field.name, column_type(field)) for field in apn_fields)))
+    db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    with CarrierSettingsLoader(input_folder) as all_settings:
+        for name in all_settings:
+            setting = all_settings[name]
+            db.execute('INSERT INTO carriers VALUES (?, ?, ?)', (
+                name,
+                setting.version if setting.HasField('version') else None,
+                os.path.basename(all_settings.sources[name]),
+            ))
+            db.executemany(
+                'INSERT INTO apns VALUES ({})'.format(
+                    ', '.join('?' * (len(apn_fields) + 2))),
+                (apn_row(name, position, apn)
+                 for position, apn in enumerate(setting.apns.apn)))
+            db.executemany('INSERT INTO configs VALUES (?, ?, ?, ?, ?, ?)',
+                           config_rows(name, setting.configs))
+    for entry in carrier_list.entry:
+        db.executemany(
+            'INSERT INTO carrier_ids VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((entry.canonical_name, position, carrier_id.mcc_mnc,
+              carrier_id.mcc_mnc[:3], carrier_id.mcc_mnc[3:],
+              carrier_id.spn if carrier_id.HasField('spn') else None,
+              carrier_id.imsi if carrier_id.HasField('imsi') else None,
+              carrier_id.gid1 if carrier_id.HasField('gid1') else None)
+             for position, carrier_id in enumerate(entry.carrier_id)))
+    db.commit()
+    return {
+        table: db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+        for table in ('carriers', 'carrier_ids', 'apns', 'configs')
+    }
@@ -0,0 +1,129 @@
+from contextlib import ExitStack
+import filecmp
+from glob import glob
+import os
+import sys
+import tempfile
+import time
+
+from carriersettings_cache import PayloadStore
+from carriersettings_files import file_digest, settings_filenames
+
+
+def snapshot(input_folder):
+    """Return the size and modification time of the .pb files of a folder."""
+    files = {}
+    for filename in glob(os.path.join(input_folder, '*.pb')):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        files[os.path.basename(filename)] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def changed_files(old, new):
+    return sorted(name for name in set(old) | set(new)
+                  if old.get(name) != new.get(name))
+
+
+def replace_changed(staging_folder, folder, filenames):
+    """Move the staged outputs that differ from those in folder into it.
+
+    Returns the names of the outputs that were replaced.
+    """
+    replaced = []
+    for name in filenames:
+        staged = os.path.join(staging_folder, name)
+        target = os.path.join(folder, name)
+        if os.path.exists(target) and filecmp.cmp(staged, target, shallow=False):
+            continue
+        os.replace(staged, target)
+        replaced.append(name)
+    return replaced
+
+
+def regenerate(extract, input_folder, apns_folder, vendor_folder, payloads,
+               **kwargs):
+    """Extract a folder into staging folders and move changed outputs in place.
+
+    extract is the extract() function of the extractor, which is passed
+    kwargs.
+
+    Outputs whose content did not change are left untouched, so that their
+    modification time does not trigger rebuilds. Returns the extraction stats
+    and the names of the outputs that were replaced.
+    """
+    with ExitStack() as stack:
+        vendor_staging = stack.enter_context(tempfile.TemporaryDirectory(
+            dir=vendor_folder, prefix='.carriersettings-'))
+        apns_staging = None
+        if apns_folder is not None:
+            apns_staging = stack.enter_context(tempfile.TemporaryDirectory(
+                dir=apns_folder, prefix='.carriersettings-'))
+        stats = extract(input_folder, apns_staging, vendor_staging,
+                        payloads=payloads, **kwargs)
+        replaced = replace_changed(vendor_staging, vendor_folder,
+                                   ['vendor.xml', 'vendor_no_sim.xml'])
+        if apns_folder is not None:
+            replaced += replace_changed(apns_staging, apns_folder,
+                                        ['apns-conf.xml'])
+    return stats, replaced
+
+
+def prune_payloads(payloads, input_folder):
+    """Forget the fragments and folders of CarrierSettings files that no
+    longer exist.
+    """
+    digests = set()
+    for filename in settings_filenames(input_folder):
+        try:
+            digests.add(file_digest(filename))
+        except FileNotFoundError:
+            continue
+    payloads.fragments = {key: fragment
+                          for key, fragment in payloads.fragments.items()
+                          if key[1] in digests}
+    payloads.files = {key: folders for key, folders in payloads.files.items()
+                      if key[1] in digests}
+
+
+def watch(extract, input_folder, apns_folder, vendor_folder, interval=1.0,
+          cache=None, **kwargs):
+    """Regenerate the outputs of a folder whenever its .pb files change.
+
+    The outputs are extracted with extract, passed the cache and kwargs, as
+    regenerate() does.
+
+    The folder is polled every interval seconds. The carrier ID index, the
+    imported protobuf modules and the fragments rendered for every carrier
+    are kept between runs, so only carriers whose file changed are decoded
+    and rendered again. Runs until interrupted.
+    """
+    payloads = PayloadStore()
+    previous = {}
+    while True:
+        current = snapshot(input_folder)
+        if current != previous:
+            if previous:
+                print("Changed: " + ', '.join(changed_files(previous, current)),
+                      file=sys.stderr)
+            start = time.perf_counter()
+            try:
+                stats, replaced = regenerate(
+                    extract, input_folder, apns_folder, vendor_folder,
+                    payloads, cache=cache, **kwargs)
+            except Exception as e:
+                # The files may still be being written; retry on the next change
+                print("Extraction failed: {}".format(e), file=sys.stderr)
+            else:
+                prune_payloads(payloads, input_folder)
+                if cache is not None:
+                    cache.prune()
+                print("{} in {:.3f}s, rendered {} carrier fragments, reused {}".format(
+                    "Updated " + ', '.join(replaced) if replaced else "Outputs unchanged",
+                    time.perf_counter() - start, stats['rendered'], stats['reused']),
+                    file=sys.stderr)
+            # Files changed during the extraction are picked up by the next poll
+            previous = current
+        time.sleep(interval)
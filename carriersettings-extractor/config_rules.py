@@ -0,0 +1,60 @@
+import hashlib
+import json
+import re
+
+
+class ConfigRules:
+    """Compiled rules deciding which carrier configs are left out.
+
+    Each rule has a name and drops the configs whose key is listed in its
+    "keys", starts with one of its "prefixes" or matches one of its "regexes".
+    A rule with "max_items" only drops the listed array configs that have more
+    items than that.
+
+    Listed keys are looked up in dicts, and the prefixes and regexes of all
+    rules are combined into one regular expression, whose matching group tells
+    which rule matched.
+    """
+
+    def __init__(self, rules):
+        self.names = [rule['name'] for rule in rules]
+        self.keys = {}
+        self.max_items = {}
+        self.groups = {}
+        patterns = []
+        for rule in rules:
+            name = rule['name']
+            for key in rule.get('keys', []):
+                if 'max_items' in rule:
+                    self.max_items.setdefault(key, (rule['max_items'], name))
+                else:
+                    self.keys.setdefault(key, name)
+            for pattern in (['^' + re.escape(prefix) for prefix in rule.get('prefixes', [])] +
+                            rule.get('regexes', [])):
+                group = 'rule{}'.format(len(self.groups))
+                self.groups[group] = name
+                patterns.append('(?P<{}>{})'.format(group, pattern))
+        self.pattern = re.compile('|'.join(patterns)) if patterns else None
+        self.digest = hashlib.sha256(
+            json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, encoding='utf-8') as f:
+            return cls(json.load(f)['rules'])
+
+    def drop_rule(self, key):
+        """Return the name of the rule dropping a config, or None."""
+        name = self.keys.get(key)
+        if name is None and self.pattern is not None:
+            match = self.pattern.search(key)
+            if match is not None:
+                name = self.groups[match.lastgroup]
+        return name
+
+    def length_rule(self, key, length):
+        """Return the name of the rule dropping an array config of length items, or None."""
+        max_items = self.max_items.get(key)
+        if max_items is not None and length > max_items[0]:
+            return max_items[1]
+        return None
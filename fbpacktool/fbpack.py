@@ -13,6 +13,8 @@
 # limitations under the License.
 #
 import collections
+import io
+import os
 
 #from google3.third_party.devsite.androidsource.en.docs.core.architecture.bootloader.tools.pixel.fw_unpack import packedstruct
 import packedstruct
@@ -45,6 +47,8 @@ class PackEntry(packedstruct.PackedStruct):
       ('slotted', 'I'),
       ('crc32', 'I'),
   ])
+  # file the entry is created from
+  __slots__ = ('filepath',)
 
   # Provide defaults.
   # pylint: disable=useless-super-delegation
@@ -85,12 +89,14 @@ class PackHeader(packedstruct.PackedStruct):
       ('total_entries', 'I'),
       ('total_size', 'I'),
   ])
+  # name of the pack file and its entries, when creating it
+  __slots__ = ('name', 'entries')
 
   def __init__(self,
                magic=FBPACK_MAGIC,
                version=FBPACK_VERSION,
                header_size=0,
-               entry_header_size=len(PackEntry()),
+               entry_header_size=PackEntry.SIZE,
                platform=b'',
                pack_version=b'',
                slot_type=0,
@@ -102,4 +108,133 @@ class PackHeader(packedstruct.PackedStruct):
                          platform, pack_version, slot_type, data_align,
                          total_entries, total_size)
     # update header size once we know all fields
-    self.header_size = len(self)
+    self.header_size = self.SIZE
+
+
+def bytes_to_str(bstr):
+  return bstr.decode().rstrip('\x00')
+
+
+class EntryReader(io.RawIOBase):
+  """Seekable read-only view of the data of a pack entry.
+
+  Data is read with positional reads straight into the caller's buffer, so
+  several readers can share the pack file, even across threads.
+  """
+
+  def __init__(self, fd, entry):
+    super(EntryReader, self).__init__()
+    self._fd = fd
+    self._offset = entry.offset
+    self._size = entry.size
+    self._pos = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, b):
+    count = max(0, min(len(b), self._size - self._pos))
+    if not count:
+      return 0
+    with memoryview(b) as view:
+      count = os.preadv(self._fd, [view[:count]], self._offset + self._pos)
+    self._pos += count
+    return count
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      offset += self._pos
+    elif whence == io.SEEK_END:
+      offset += self._size
+    elif whence != io.SEEK_SET:
+      raise ValueError('invalid whence {}'.format(whence))
+    if offset < 0:
+      raise ValueError('negative seek position {}'.format(offset))
+    self._pos = offset
+    return offset
+
+  def tell(self):
+    return self._pos
+
+
+class FbPack(object):
+  """Reader of a packed image.
+
+  The header is parsed when the pack is opened. The entry table is read and
+  indexed by name and product the first time entries are looked up.
+  """
+
+  def __init__(self, file_name):
+    self.file = open(file_name, 'rb')
+    try:
+      self.header = PackHeader.unpack_from(
+          os.pread(self.file.fileno(), PackHeader.SIZE, 0))
+      if self.header.version != FBPACK_VERSION:
+        raise NotImplementedError('unsupported version {}'.format(
+            self.header.version))
+      if self.header.entry_header_size != PackEntry.SIZE:
+        raise NotImplementedError('unsupported entry header size {}'.format(
+            self.header.entry_header_size))
+    except BaseException:
+      self.file.close()
+      raise
+    self._entries = None
+    self._by_name = None
+    self._by_product = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    self.file.close()
+
+  @property
+  def entries(self):
+    """The entries of the pack, in pack order."""
+    if self._entries is None:
+      table = os.pread(self.file.fileno(),
+                       self.header.total_entries * PackEntry.SIZE,
+                       self.header.header_size)
+      if len(table) != self.header.total_entries * PackEntry.SIZE:
+        raise EOFError('truncated entry table')
+      self._entries = list(PackEntry.iter_unpack(memoryview(table)))
+    return self._entries
+
+  def _index(self):
+    if self._by_name is not None:
+      return
+    self._by_name = collections.defaultdict(list)
+    self._by_product = collections.defaultdict(set)
+    for i, entry in enumerate(self.entries):
+      self._by_name[bytes_to_str(entry.name)].append(i)
+      # entries without a product are for every product, and indexed as ''
+      for product in bytes_to_str(entry.product).split('|'):
+        self._by_product[product].add(i)
+
+  def find(self, names=(), product=''):
+    """Returns the entries named one of names, or all, in pack order.
+
+    With product, only the entries for that product, or without a product,
+    are returned.
+    """
+    self._index()
+    if names:
+      indexes = sorted(
+          set(i for name in names for i in self._by_name.get(name, ())))
+    else:
+      indexes = range(len(self.entries))
+    if product:
+      products = self._by_product.get(product, set()) | self._by_product.get(
+          '', set())
+      indexes = [i for i in indexes if i in products]
+    return [self.entries[i] for i in indexes]
+
+  def open(self, entry):
+    """Returns a seekable read-only file object over the data of entry."""
+    return EntryReader(self.file.fileno(), entry)
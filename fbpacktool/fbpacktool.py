@@ -14,27 +14,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import functools
+import json
 import logging
 import os
 import sys
-from lxml.etree import XMLParser
+import time
+import zlib
+from lxml import etree
 import yaml
 
 #from google3.third_party.devsite.androidsource.en.docs.core.architecture.bootloader.tools.pixel.fw_unpack import fbpack
 import fbpack
 
-def bytes_to_str(bstr):
-  return bstr.decode().rstrip('\x00')
-
-
 def print_pack_header(pack):
   print('magic:              {:#x}'.format(pack.magic))
   print('version:            {}'.format(pack.version))
   print('header size:        {}'.format(pack.header_size))
   print('entry header size:  {}'.format(pack.entry_header_size))
-  platform = bytes_to_str(pack.platform)
+  platform = fbpack.bytes_to_str(pack.platform)
   print('platform:           {}'.format(platform))
-  pack_version = bytes_to_str(pack.pack_version)
+  pack_version = fbpack.bytes_to_str(pack.pack_version)
   print('pack version:       {}'.format(pack_version))
   print('slock type:         {}'.format(pack.slot_type))
   print('data align:         {}'.format(pack.data_align))
@@ -43,7 +45,7 @@ def print_pack_header(pack):
 
 
 def print_pack_entry(entry, prefix):
-  name = bytes_to_str(entry.name)
+  name = fbpack.bytes_to_str(entry.name)
   print('{}name:       {}'.format(prefix, name))
   etype = 'unknown'
   if entry.type == fbpack.FBPACK_PARTITION_TABLE:
@@ -55,7 +57,7 @@ def print_pack_entry(entry, prefix):
   else:
     print('entry else')
   print('{}type:       {}'.format(prefix, etype))
-  product = bytes_to_str(entry.product)
+  product = fbpack.bytes_to_str(entry.product)
   print('{}product:    {}'.format(prefix, product))
   print('{}offset:     {:#x} ({})'.format(prefix, entry.offset, entry.offset))
   print('{}size:       {:#x} ({})'.format(prefix, entry.size, entry.size))
@@ -64,18 +66,12 @@ def print_pack_entry(entry, prefix):
 
 
 def cmd_info(args):
-  with open(args.file, 'rb') as f:
-    pack = fbpack.PackHeader.from_bytes(f.read(len(fbpack.PackHeader())))
-
-    if pack.version != fbpack.FBPACK_VERSION:
-      raise NotImplementedError('unsupported version {}'.format(pack.version))
-
+  with fbpack.FbPack(args.file) as pack:
     print('Header:')
-    print_pack_header(pack)
+    print_pack_header(pack.header)
 
     print('\nEntries:')
-    for i in range(1, pack.total_entries + 1):
-      entry = fbpack.PackEntry.from_bytes(f.read(len(fbpack.PackEntry())))
+    for i, entry in enumerate(pack.entries, 1):
       print('Entry {}: {{'.format(i))
       print_pack_entry(entry, '    ')
       print('}')
@@ -85,30 +81,217 @@ def align_up(val, align):
   return (val + align - 1) & ~(align - 1)
 
 
-def create_pack_file(file_name, in_dir_name, pack):
+# Size of the buffer each input file is streamed through
+CREATE_CHUNK_SIZE = 1 << 20
+
+
+def layout_pack(in_dir_name, pack):
+  """Sets the offset and size of every entry from the size of its file."""
   pack.total_entries = len(pack.entries)
   offset = pack.header_size + pack.total_entries * pack.entry_header_size
+  for entry in pack.entries:
+    # align data
+    offset = align_up(offset, pack.data_align)
+    entry.offset = offset
+    entry.size = os.stat(os.path.join(in_dir_name, entry.filepath)).st_size
+    offset += entry.size
+  pack.total_size = offset
+
+
+def write_entry_data(fd, in_dir_name, entry):
+  """Streams the file of an entry to its offset in fd and sets its crc32."""
+  buf = memoryview(bytearray(CREATE_CHUNK_SIZE))
+  crc = 0
+  offset = entry.offset
+  remaining = entry.size
+  fin_name = os.path.join(in_dir_name, entry.filepath)
+  with open(fin_name, 'rb', buffering=0) as fin:
+    while remaining > 0:
+      read = fin.readinto(buf[:min(CREATE_CHUNK_SIZE, remaining)])
+      if not read:
+        raise EOFError('{} shrank while packing it'.format(fin_name))
+      crc = zlib.crc32(buf[:read], crc)
+      data = buf[:read]
+      while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+      remaining -= read
+  entry.crc32 = crc
+
+
+def layout_key(in_dir_name, pack):
+  """Returns what the layout of a pack and the crc32 of its entries depend on."""
+  files = []
+  for entry in pack.entries:
+    fin_name = os.path.abspath(os.path.join(in_dir_name, entry.filepath))
+    st = os.stat(fin_name)
+    files.append([fin_name, st.st_size, st.st_mtime_ns])
+  return {
+      'header_size': pack.header_size,
+      'entry_header_size': pack.entry_header_size,
+      'data_align': pack.data_align,
+      'files': files,
+  }
+
+
+def output_key(file_name):
+  st = os.stat(file_name)
+  return [os.path.abspath(file_name), st.st_size, st.st_mtime_ns]
+
+
+def load_layout(layout_file_name, key, file_name):
+  """Returns the cached layout of a pack, if its inputs and file are unchanged."""
+  try:
+    with open(layout_file_name) as f:
+      layout = json.load(f)
+    if layout['key'] != key or layout['output'] != output_key(file_name):
+      return None
+  except (OSError, ValueError, KeyError):
+    return None
+  return layout
+
+
+def save_layout(layout_file_name, key, file_name, pack):
+  layout = {
+      'key': key,
+      'output': output_key(file_name),
+      'total_size': pack.total_size,
+      'entries': [[entry.offset, entry.size, entry.crc32]
+                  for entry in pack.entries],
+  }
+  tmp_name = '{}.{}.tmp'.format(layout_file_name, os.getpid())
+  try:
+    with open(tmp_name, 'w') as f:
+      json.dump(layout, f)
+    os.replace(tmp_name, layout_file_name)
+  except OSError as e:
+    logging.warning('Could not cache the layout in {}: {}'.format(
+        layout_file_name, e))
+
+
+def write_pack_header(f, pack):
+  f.seek(0)
+  # write pack header
+  f.write(bytes(pack))
+  # iterate over entries again to write entry header
+  for entry in pack.entries:
+    f.write(bytes(entry))
+
+
+def create_pack_file(file_name, in_dir_name, pack, jobs=1,
+                     layout_file_name=None):
+  """Writes pack and the files of its entries, found in in_dir_name.
+
+  The layout is computed from the size of the files up front, so that up to
+  jobs entries can be streamed to their offsets at once, computing their
+  crc32 on the way. Alignment gaps are left as holes.
+
+  With layout_file_name, the layout and crc32 of the entries are cached in
+  that file. When the pack is created again from input files of the same
+  size and modification time, and file_name was not modified since, only
+  the header and entry table are written again.
+  """
+  key = None
+  if layout_file_name is not None:
+    key = layout_key(in_dir_name, pack)
+    layout = load_layout(layout_file_name, key, file_name)
+    if layout is not None:
+      pack.total_entries = len(pack.entries)
+      pack.total_size = layout['total_size']
+      for entry, (offset, size, crc32) in zip(pack.entries, layout['entries']):
+        entry.offset, entry.size, entry.crc32 = offset, size, crc32
+      logging.info('Inputs unchanged, writing the header of {}'.format(
+          file_name))
+      with open(file_name, 'r+b') as f:
+        write_pack_header(f, pack)
+      save_layout(layout_file_name, key, file_name, pack)
+      return
+
+  layout_pack(in_dir_name, pack)
   with open(file_name, 'wb') as f:
+    f.truncate(pack.total_size)
     # write entries data
-    for entry in pack.entries:
-      # align data
-      offset = align_up(offset, pack.data_align)
-      entry.offset = offset
-      f.seek(offset)
-      fin_name = os.path.join(in_dir_name, entry.filepath)
-      with open(fin_name, 'rb') as fin:
-        data = fin.read()
-        entry.size = len(data)
-        f.write(data)
-        offset += len(data)
-
-    pack.total_size = offset
-    f.seek(0)
-    # write pack header
-    f.write(bytes(pack))
-    # iterate over entries again to write entry header
-    for entry in pack.entries:
-      f.write(bytes(entry))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+      # list() to raise the first error
+      list(executor.map(functools.partial(write_entry_data, f.fileno(),
+                                          in_dir_name), pack.entries))
+
+    write_pack_header(f, pack)
+  if layout_file_name is not None:
+    save_layout(layout_file_name, key, file_name, pack)
+
+
+ENTRY_TYPES = {
+    'partition-table': fbpack.FBPACK_PARTITION_TABLE,
+    'partition': fbpack.FBPACK_PARTITION_DATA,
+    'sideload': fbpack.FBPACK_SIDELOAD_DATA,
+}
+
+
+def parse_bool(value):
+  if isinstance(value, str):
+    return value.lower() in ('1', 'true', 'yes')
+  return bool(value)
+
+
+def parse_manifest(manifest):
+  """Builds a PackHeader from a manifest parsed to a dict.
+
+  The manifest has the name of the pack, optionally its platform, slot_type
+  and data_align, and a list of entries. Each entry has a name, and
+  optionally a type (partition-table, partition or sideload, default
+  partition), a product or list of products, whether it is slotted and the
+  filepath of its data, name.img by default.
+  """
+  if 'name' not in manifest:
+    raise ValueError('the manifest has no pack name')
+  pack = fbpack.PackHeader(
+      platform=str(manifest.get('platform', '')).encode('ascii'),
+      slot_type=int(manifest.get('slot_type', 0)),
+      data_align=int(manifest.get('data_align',
+                                  fbpack.FBPACK_DEFAULT_DATA_ALIGN)))
+  pack.name = str(manifest['name'])
+  pack.entries = []
+  for i, item in enumerate(manifest.get('entries') or []):
+    if 'name' not in item:
+      raise ValueError('entry {} has no name'.format(i))
+    name = str(item['name'])
+    etype = item.get('type', 'partition')
+    if etype in ENTRY_TYPES:
+      etype = ENTRY_TYPES[etype]
+    else:
+      try:
+        etype = int(etype)
+      except ValueError:
+        raise ValueError('{}: unknown entry type {}'.format(name, etype))
+    product = item.get('product', '')
+    if isinstance(product, list):
+      product = '|'.join(product)
+    entry = fbpack.PackEntry(etype, name.encode('ascii'),
+                             str(product).encode('ascii'),
+                             slotted=int(parse_bool(item.get('slotted', False))))
+    entry.filepath = str(item.get('filepath', name + '.img'))
+    pack.entries.append(entry)
+  return pack
+
+
+def load_manifest(file_name):
+  """Loads a YAML or XML pack manifest.
+
+  In XML, the pack is the root element, with the attributes of the pack,
+  and each entry an <entry> element with the attributes of the entry.
+  """
+  if file_name.lower().endswith('.yaml'):
+    with open(file_name) as f:
+      manifest = yaml.safe_load(f)
+  else:
+    root = etree.parse(file_name).getroot()
+    manifest = dict(root.attrib)
+    manifest['entries'] = [dict(entry.attrib) for entry in root.iter('entry')]
+  if not isinstance(manifest, dict):
+    raise ValueError('{}: not a pack manifest'.format(file_name))
+  return parse_manifest(manifest)
 
 
 def cmd_create(args):
@@ -116,13 +299,9 @@ def cmd_create(args):
           args.file.lower().endswith('.yaml')):
     raise NotImplementedError('{} type not supported'.format(args.file))
 
-  pack = None
-  if args.file.lower().endswith('.yaml'):
-    pack = yaml.parse(args.file)
-  else:
-    pack = XMLParser.parse(args.file)
+  pack = load_manifest(args.file)
   pack.pack_version = bytes(str(args.pack_version).encode('ascii'))
-  pack.header_size = len(pack)
+  pack.header_size = pack.SIZE
 
   # create output directory if missing
   if not os.path.isdir(args.out_dir):
@@ -130,37 +309,125 @@ def cmd_create(args):
 
   file_name = os.path.join(args.out_dir, pack.name + '.img')
 
-  create_pack_file(file_name, args.in_dir, pack)
-
+  layout_file_name = None
+  if not args.no_layout_cache:
+    # cache the layout next to the manifest
+    layout_file_name = args.file + '.layout.json'
+  create_pack_file(file_name, args.in_dir, pack, args.jobs, layout_file_name)
 
-def product_match(products, product):
-  return product in products.split(b'|')
 
+def copyfileobj(src_fd, dst, offset, file_size):
+  """Copies file_size bytes from offset in src_fd to dst, if not None.
 
-def copyfileobj(src, dst, file_size):
+  Returns:
+    The CRC32 of the data copied.
+  """
+  crc = 0
   while file_size > 0:
-    buf = src.read(min(128 * 1024, file_size))
-    dst.write(buf)
+    buf = os.pread(src_fd, min(128 * 1024, file_size), offset)
+    if not buf:
+      raise EOFError('unexpected end of file')
+    crc = zlib.crc32(buf, crc)
+    if dst is not None:
+      # dst may be unbuffered, where a write can be short
+      data = memoryview(buf)
+      while data:
+        data = data[dst.write(data):]
+    offset += len(buf)
     file_size -= len(buf)
+  return crc
+
+
+# Errors meaning that a kernel-side copy is not supported between two files
+KERNEL_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                      errno.EBADF)
+# Most bytes copied by a single copy_file_range or sendfile call
+KERNEL_COPY_CHUNK = 1 << 30
+
+
+def kernel_copy(method, src_fd, dst_fd, offset, count):
+  if method == 'copy_file_range':
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+  return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def copy_file_range(src, dst, offset, size):
+  """Copies size bytes from offset in src to the current position of dst.
+
+  The data is copied by the kernel with os.copy_file_range, or os.sendfile
+  where the files do not support it, and through a userspace buffer when
+  neither is available. src is only read at explicit offsets, never moving
+  its position, so several entries can be copied from it at once. dst must
+  be unbuffered.
+
+  Args:
+    src: file object to copy from.
+    dst: unbuffered file object to copy to.
+    offset: offset of the data in src.
+    size: number of bytes to copy.
+
+  Returns:
+    The name of the method the copy was completed with.
+  """
+  copied = 0
+  for method in ('copy_file_range', 'sendfile'):
+    if not hasattr(os, method):
+      continue
+    try:
+      while copied < size:
+        count = kernel_copy(method, src.fileno(), dst.fileno(), offset + copied,
+                            min(size - copied, KERNEL_COPY_CHUNK))
+        if not count:
+          raise EOFError('unexpected end of file')
+        copied += count
+      return method
+    except OSError as e:
+      if e.errno not in KERNEL_COPY_ERRORS:
+        raise
+  # Copy whatever the kernel did not
+  copyfileobj(src.fileno(), dst, offset + copied, size - copied)
+  return 'read/write'
+
+
+def throughput(size, elapsed):
+  return size / elapsed / (1 << 20) if elapsed else 0
+
+
+def check_crc32(entry, crc):
+  if crc != entry.crc32:
+    raise RuntimeError('{}: crc32 mismatch (expected {:#010x}, got {:#010x})'
+                       .format(fbpack.bytes_to_str(entry.name), entry.crc32, crc))
+
+
+def unpack_entry(f, entry, entry_filename, verify=True):
+  """Unpacks an entry to entry_filename.
+
+  Entries with a crc32 are copied through a userspace buffer to check it as
+  they are copied, unless verify is False, and others in the kernel.
+  """
+  name = fbpack.bytes_to_str(entry.name)
+  logging.info('Unpacking {} (size: {}, offset: {})'.format(
+      name, entry.size, entry.offset))
+  start = time.perf_counter()
+  with open(entry_filename, 'wb', buffering=0) as entry_file:
+    if verify and entry.crc32:
+      crc = copyfileobj(f.fileno(), entry_file, entry.offset, entry.size)
+      method = 'read/write, crc32 checked'
+    else:
+      crc = None
+      method = copy_file_range(f, entry_file, entry.offset, entry.size)
+  if crc is not None and crc != entry.crc32:
+    # do not leave a corrupt image behind
+    os.remove(entry_filename)
+    check_crc32(entry, crc)
+  elapsed = time.perf_counter() - start
+  logging.info('Unpacked {} in {:.3f}s ({:.1f} MiB/s, {})'.format(
+      name, elapsed, throughput(entry.size, elapsed), method))
 
 
 def cmd_unpack(args):
-  with open(args.file, 'rb') as f:
-    pack = fbpack.PackHeader.from_bytes(f.read(len(fbpack.PackHeader())))
-
-    if pack.version != fbpack.FBPACK_VERSION:
-      raise NotImplementedError('unsupported version {}'.format(pack.version))
-
-    entries = []
-    # create list of entries we want to extact
-    for _ in range(pack.total_entries):
-      entry = fbpack.PackEntry.from_bytes(f.read(len(fbpack.PackEntry())))
-      name = bytes_to_str(entry.name)
-      if not args.partitions or name in args.partitions:
-        # if both product are valid then match product name too
-        if not args.product or not entry.product or product_match(
-            entry.product, args.product):
-          entries.append(entry)
+  with fbpack.FbPack(args.file) as pack:
+    entries = pack.find(args.partitions, args.product)
 
     if not entries and not args.unpack_ver:
       raise RuntimeError('no images to unpack')
@@ -170,29 +437,75 @@ def cmd_unpack(args):
       os.makedirs(args.out_dir, 0o755)
 
     out_files = {}
-    # write file per entry
+    entry_filenames = []
+    # name the file of each entry in pack order, so that duplicates are
+    # numbered the same however the entries are unpacked
     for entry in entries:
-      name = bytes_to_str(entry.name)
-      logging.info('Unpacking {} (size: {}, offset: {})'.format(
-          name, entry.size, entry.offset))
-      f.seek(entry.offset)
+      name = fbpack.bytes_to_str(entry.name)
       entry_filename = os.path.join(args.out_dir, name + '.img')
       instance = out_files.get(entry_filename, 0) + 1
       out_files[entry_filename] = instance
       if instance > 1:
         entry_filename = os.path.join(args.out_dir,
                                       name + '({}).img'.format(instance - 1))
-      with open(entry_filename, 'wb') as entry_file:
-        copyfileobj(f, entry_file, entry.size)
+      entry_filenames.append(entry_filename)
+
+    # write file per entry
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+      # list() to raise the first error
+      list(executor.map(functools.partial(unpack_entry, pack.file,
+                                          verify=args.verify),
+                        entries, entry_filenames))
 
     if args.unpack_ver:
       ver_file_path = os.path.join(args.out_dir, 'version.txt')
       with open(ver_file_path, 'w') as ver_file:
-        ver_file.write(bytes_to_str(pack.pack_version))
+        ver_file.write(fbpack.bytes_to_str(pack.header.pack_version))
 
   logging.info('Done')
 
 
+def verify_entry(f, entry):
+  """Checks the crc32 of an entry and returns its status and throughput."""
+  if not entry.crc32:
+    return 'no crc32', 0
+  start = time.perf_counter()
+  try:
+    check_crc32(entry, copyfileobj(f.fileno(), None, entry.offset, entry.size))
+  except EOFError:
+    return 'truncated', 0
+  except RuntimeError:
+    return 'crc32 mismatch', 0
+  return 'ok', throughput(entry.size, time.perf_counter() - start)
+
+
+def cmd_verify(args):
+  """Checks the crc32 of every selected entry.
+
+  Returns:
+    1 if any entry is truncated or has the wrong crc32, 0 otherwise. Entries
+    without a crc32 are reported but do not fail the check.
+
+  Raises:
+    RuntimeError: if no entry is selected.
+  """
+  with fbpack.FbPack(args.file) as pack:
+    entries = pack.find(args.partitions, args.product)
+    if not entries:
+      raise RuntimeError('no images to verify')
+    failed = False
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+      results = executor.map(functools.partial(verify_entry, pack.file),
+                             entries)
+      for entry, (status, speed) in zip(entries, results):
+        line = '{}: {}'.format(fbpack.bytes_to_str(entry.name), status)
+        if status == 'ok':
+          line += ' ({:.1f} MiB/s)'.format(speed)
+        print(line)
+        failed = failed or status not in ('ok', 'no crc32')
+  return 1 if failed else 0
+
+
 def parse_args():
   parser = argparse.ArgumentParser(
       description='Tool to create/modify/inspect fastboot packed images')
@@ -221,6 +534,17 @@ def parse_args():
       default='.')
   create.add_argument(
       '-v', '--pack_version', help='Packed image version ', default='')
+  create.add_argument(
+      '-j',
+      '--jobs',
+      type=int,
+      default=1,
+      help='number of images to pack at once')
+  create.add_argument(
+      '--no-layout-cache',
+      action='store_true',
+      help='always write the whole image, without caching its layout next '
+      'to the config file')
   create.add_argument(
       'file', help='config file describing packed image (yaml/xml)')
   create.set_defaults(func=cmd_create)
@@ -236,6 +560,17 @@ def parse_args():
       '--unpack_ver',
       help='Unpack version to a file',
       action='store_true')
+  unpack.add_argument(
+      '-j',
+      '--jobs',
+      type=int,
+      default=1,
+      help='number of images to unpack at once')
+  unpack.add_argument(
+      '--no-verify',
+      dest='verify',
+      action='store_false',
+      help='do not check the crc32 of the images, copying them in the kernel')
   unpack.add_argument('file', help='packed image file')
   unpack.add_argument(
       'partitions',
@@ -245,6 +580,25 @@ def parse_args():
       help='Partition names to extract (default all).')
   unpack.set_defaults(func=cmd_unpack)
 
+  # verify command
+  verify = subparsers.add_parser('verify')
+  verify.add_argument(
+      '-p', '--product', help='filter images by product', default='')
+  verify.add_argument(
+      '-j',
+      '--jobs',
+      type=int,
+      default=os.cpu_count(),
+      help='number of images to check at once')
+  verify.add_argument('file', help='packed image file')
+  verify.add_argument(
+      'partitions',
+      metavar='PART',
+      type=str,
+      nargs='*',
+      help='Partition names to check (default all).')
+  verify.set_defaults(func=cmd_verify)
+
   args = parser.parse_args()
   # make sure a command was passed
   if not hasattr(args, 'func'):
@@ -268,7 +622,7 @@ def main():
   logging.basicConfig(level=log_level)
 
   # execute command
-  args.func(args)
+  sys.exit(args.func(args))
 
 
 if __name__ == '__main__':
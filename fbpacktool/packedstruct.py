@@ -16,7 +16,28 @@ import collections
 import struct
 
 
-class PackedStruct(object):
+class PackedStructMeta(type):
+  """Metaclass compiling the struct of each PackedStruct subclass once.
+
+  The fields of the subclass become its __slots__, along with any __slots__
+  it declares for attributes that are not packed.
+  """
+
+  def __new__(mcs, name, bases, namespace):
+    fields = namespace.get('_FIELDS')
+    if fields is not None:
+      namespace['__slots__'] = tuple(fields) + tuple(
+          namespace.get('__slots__', ()))
+    else:
+      namespace.setdefault('__slots__', ())
+    cls = super(PackedStructMeta, mcs).__new__(mcs, name, bases, namespace)
+    if fields is not None:
+      cls._STRUCT = struct.Struct('<' + ''.join(fields.values()))
+      cls.SIZE = cls._STRUCT.size
+    return cls
+
+
+class PackedStruct(object, metaclass=PackedStructMeta):
   """Class representing a C style packed structure.
 
   Derived classes need to provide a dictionary where the keys are the attributes
@@ -29,12 +50,14 @@ class PackedStruct(object):
       }
 
   In this case Foo.x will represent an "unsigned int" C value, while Foo.name
-  will be a "char[64]" C value.
+  will be a "char[64]" C value. The structure is compiled once, when the class
+  is defined, and its size is Foo.SIZE.
   """
   _FIELDS: collections.OrderedDict
+  _STRUCT: struct.Struct
+  SIZE: int
 
   def __init__(self, *args, **kwargs):
-    self._fmt = '<' + ''.join(fmt for fmt in self._FIELDS.values())
     for name in self._FIELDS:
       setattr(self, name, None)
 
@@ -49,15 +72,36 @@ class PackedStruct(object):
         for k in self._FIELDS) + '\n}'
 
   def __str__(self):
-    return struct.pack(self._fmt, *(getattr(self, x) for x in self._FIELDS))
+    return self._STRUCT.pack(*(getattr(self, x) for x in self._FIELDS))
 
   def __bytes__(self):
-    return struct.pack(self._fmt, *(getattr(self, x) for x in self._FIELDS))
+    return self._STRUCT.pack(*(getattr(self, x) for x in self._FIELDS))
 
   def __len__(self):
-    return struct.calcsize(self._fmt)
+    return self.SIZE
+
+  @classmethod
+  def _from_values(cls, values):
+    # Bypass __init__, whose defaults must not override the unpacked values
+    obj = cls.__new__(cls)
+    for name, val in zip(cls._FIELDS, values):
+      setattr(obj, name, val)
+    return obj
 
   @classmethod
   def from_bytes(cls, data):
-    fmt_str = '<' + ''.join(fmt for fmt in cls._FIELDS.values())
-    return cls(*struct.unpack(fmt_str, data))
+    return cls._from_values(cls._STRUCT.unpack(data))
+
+  @classmethod
+  def unpack_from(cls, buffer, offset=0):
+    """Unpacks a structure at offset in buffer, without copying it."""
+    return cls._from_values(cls._STRUCT.unpack_from(buffer, offset))
+
+  @classmethod
+  def iter_unpack(cls, buffer):
+    """Iterates over the structures packed one after another in buffer.
+
+    The size of buffer must be a multiple of SIZE.
+    """
+    for values in cls._STRUCT.iter_unpack(buffer):
+      yield cls._from_values(values)